@@ -6,6 +6,7 @@ setup(
     name="wmhparc",
     version="1.0",
     packages=find_packages(),
+    package_data={"wmhparc": ["benchmark_references.json"]},
 
     install_requires = [
         "SimpleITK==2.4.0",
@@ -15,6 +16,7 @@ setup(
         "matplotlib-inline==0.1.7",
         "numpy==1.26.4",
         "pandas==2.2.3",
+        "pyarrow==18.1.0",
         "scipy==1.14.1",
     ]
 )
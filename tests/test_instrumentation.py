@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from wmhparc.instrumentation import RunReport, _reset_peak_rss
+
+
+@pytest.mark.skipif(not _reset_peak_rss(), reason="the peak resident memory can only be reset on linux")
+def test_nested_stage_keeps_outer_peak():
+    report = RunReport("subject")
+    with report.stage("outer"):
+        block = np.ones(200 * 1024 * 1024 // 8)
+        del block
+        with report.stage("inner"):
+            pass
+    inner, outer = report.stages
+    assert inner['stage'] == "inner" and outer['stage'] == "outer"
+    assert outer['peak_rss_mb'] >= inner['peak_rss_mb'] + 150
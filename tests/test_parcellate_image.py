@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from wmhparc.concentric_layers import layer_boundaries, ring_labels
+from wmhparc.parcellate_image import bullseye_labels, create_combined_regions, brain_roi_table, regions, parcellate_many, parc_stats
+
+
+def naive_bullseye(norm_dist, brainmask, atlas, boundaries):
+    n_layers = len(boundaries) + 1
+    lobe_index = {region: k for k, region in enumerate(regions.keys())}
+    out = np.zeros(atlas.shape, dtype=np.int64)
+    for idx in np.ndindex(atlas.shape):
+        if not brainmask[idx] or np.isnan(norm_dist[idx]) or atlas[idx] not in lobe_index:
+            continue
+        ring = 1 + sum(norm_dist[idx] >= boundary for boundary in boundaries)
+        out[idx] = lobe_index[atlas[idx]] * n_layers + ring
+    return out
+
+
+@pytest.mark.parametrize("n_layers", [4, 20, 21, 25, 40])
+def test_bullseye_labels_many_layers(n_layers):
+    rng = np.random.default_rng(n_layers)
+    shape = (6, 7, 8)
+    atlas = rng.integers(0, max(regions) + 2, size=shape).astype(np.uint8)
+    norm_dist = rng.random(shape).astype(np.float32)
+    norm_dist[0, 0, :3] = np.nan
+    brainmask = rng.random(shape) > 0.1
+    boundaries = layer_boundaries(n_layers)
+
+    expected = naive_bullseye(norm_dist, brainmask, atlas, boundaries)
+    brain_rois = bullseye_labels(norm_dist, brainmask, atlas, boundaries)
+    np.testing.assert_array_equal(brain_rois, expected)
+    assert brain_rois.max() <= max(brain_roi_table(n_layers))
+
+    rings = ring_labels(norm_dist, brainmask, boundaries)
+    np.testing.assert_array_equal(create_combined_regions(atlas, rings, n_layers), expected)
+
+
+def test_parcellate_many_thresholds_match_single_threshold_with_nan():
+    rng = np.random.default_rng(0)
+    shape = (10, 11, 12)
+    brainroi = rng.integers(0, 40, size=shape).astype(np.uint8)
+    wmh = rng.random(shape)
+    wmh[rng.random(shape) < 0.2] = np.nan
+    wmh[0, 0, 0] = np.inf
+    thresholds = [0.1, 0.5, 0.9]
+
+    df = parcellate_many(brainroi, {'prob': wmh}, 1.5, thresholds=thresholds)
+    for k, threshold in enumerate(thresholds):
+        with np.errstate(invalid='ignore'):
+            expected = parc_stats(brainroi, wmh >= threshold, 1.5)
+        for column in expected.columns:
+            assert df.iloc[k][column] == pytest.approx(expected[column].iloc[0]), (threshold, column)
@@ -0,0 +1,42 @@
+import os
+import uuid
+from wmhparc.stage_cache import StageCache
+
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def run_pipeline(folder, calls):
+    cache = StageCache(str(folder))
+
+    def upstream():
+        calls.append("upstream")
+        # an unseeded stage: every run writes a different result
+        return write(os.path.join(folder, "transform.txt"), uuid.uuid4().hex)
+
+    def downstream(path):
+        calls.append("downstream")
+        with open(path) as f:
+            return write(os.path.join(folder, "warped.txt"), f.read())
+
+    transform, transform_key = cache.run("upstream", upstream, params={'seed': None})
+    return cache.run("downstream", lambda: downstream(transform), upstream=[transform_key])
+
+
+def test_unchanged_stages_are_skipped(tmp_path):
+    calls = []
+    run_pipeline(tmp_path, calls)
+    run_pipeline(tmp_path, calls)
+    assert calls == ["upstream", "downstream"]
+
+
+def test_downstream_reruns_when_upstream_output_changes(tmp_path):
+    calls = []
+    run_pipeline(tmp_path, calls)
+    os.remove(tmp_path / "transform.txt")
+    run_pipeline(tmp_path, calls)
+    assert calls == ["upstream", "downstream", "upstream", "downstream"]
+    assert (tmp_path / "warped.txt").read_text() == (tmp_path / "transform.txt").read_text()
@@ -0,0 +1,193 @@
+"""
+Benchmark of the pipeline stages on synthetic SynthSeg-like phantoms.
+
+Every stage except registration runs on label volumes only, so it can be timed and checked on a phantom made of
+nested ellipsoids: ventricles inside white matter inside a cortex shell, with a lobe atlas of wedges and a set of
+spherical WMH lesions. The phantom is defined in mm, so the same anatomy can be generated at any voxel spacing.
+For each stage the wall time and the peak memory allocated (as traced by tracemalloc) are reported, and the
+outputs are summarised and checked against the references stored in benchmark_references.json.
+"""
+import os
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import SimpleITK as sitk
+from wmhparc.concentric_layers import distance_maps, compute_pv_distance_rings
+from wmhparc.parcellate_image import create_combined_regions, bullseye_labels, parcellate_from_brainroi, get_all_brain_volumes, label_histogram
+from wmhparc.lesion_stats import lesion_stats
+
+REFERENCES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_references.json")
+
+# field of view of the phantom in mm (x, y, z)
+PHANTOM_FOV = (192, 224, 192)
+
+# named phantom configurations: voxel spacing in mm (x, y, z)
+PHANTOM_CONFIGS = {
+    '2mm': (2.0, 2.0, 2.0),
+    '1mm': (1.0, 1.0, 1.0),
+    'anisotropic': (1.0, 1.0, 3.0),
+}
+
+def make_phantom(spacing=(1.0, 1.0, 1.0), fov=PHANTOM_FOV, seed=0):
+    """
+    creates a synthetic subject at the given voxel spacing.
+    returns a dict of sitk images: synthseg, atlas (lobe atlas), brainmask and wmh.
+    """
+    spacing = np.asarray(spacing, dtype=np.float64)
+    size = np.maximum(np.round(np.asarray(fov) / spacing), 1).astype(int)
+
+    # physical coordinates (mm) relative to the centre of the field of view, arrays indexed (z, y, x)
+    z, y, x = np.meshgrid(*[(np.arange(n) - (n - 1) / 2) * s for n, s in zip(size[::-1], spacing[::-1])], indexing='ij', sparse=True)
+
+    def ellipsoid(radii, centre=(0, 0, 0)):
+        return ((x - centre[0]) / radii[0]) ** 2 + ((y - centre[1]) / radii[1]) ** 2 + ((z - centre[2]) / radii[2]) ** 2
+
+    brain = ellipsoid((70, 85, 60))
+    left = np.broadcast_to(x < 0, brain.shape)
+
+    synthseg = np.zeros(brain.shape, dtype=np.int32)
+    synthseg[brain <= 1.0] = np.where(left, 3, 42)[brain <= 1.0]
+    white_matter = brain <= 0.85
+    synthseg[white_matter] = np.where(left, 2, 41)[white_matter]
+    for centre, label in [((-10, 0, 5), 4), ((10, 0, 5), 43)]:
+        synthseg[ellipsoid((6, 25, 10), centre) <= 1.0] = label
+
+    # lobes as wedges along the anterior-posterior and inferior-superior axes, with the bgit region in the centre
+    lobe = np.select(
+        [np.broadcast_to(y > 20, brain.shape), np.broadcast_to(y <= -30, brain.shape), np.broadcast_to(z > 0, brain.shape)],
+        [1, 4, 2], default=3,
+    )
+    atlas = np.where(left, lobe, lobe + 7).astype(np.int16)
+    atlas[ellipsoid((25, 30, 20)) <= 1.0] = 5
+    atlas[brain > 1.0] = 0
+
+    brainmask = (brain <= 1.05).astype(np.uint8)
+
+    # periventricular and deep lesions of varying size
+    rng = np.random.default_rng(seed)
+    wmh = np.zeros(brain.shape, dtype=np.uint8)
+    centres = rng.uniform(-1, 1, size=(40, 3)) * np.array([50, 60, 40])
+    radii = rng.uniform(2, 8, size=40)
+    for centre, radius in zip(centres, radii):
+        wmh[(ellipsoid((radius, radius, radius), centre) <= 1.0) & white_matter] = 1
+
+    images = {}
+    for name, array in [('synthseg', synthseg), ('atlas', atlas), ('brainmask', brainmask), ('wmh', wmh)]:
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing([float(s) for s in spacing])
+        image.SetOrigin([float(-(n - 1) / 2 * s) for n, s in zip(size, spacing)])
+        images[name] = image
+    return images
+
+def _measure(fn, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'wall_time_s': wall_time, 'peak_alloc_mb': peak / 2 ** 20}
+
+def run_benchmark(spacing=(1.0, 1.0, 1.0), fov=PHANTOM_FOV):
+    """
+    runs each stage on a phantom at the given spacing.
+    returns (timings, summary): a dict of stage -> {wall_time_s, peak_alloc_mb} and a dict summarising the outputs.
+    """
+    phantom = make_phantom(spacing, fov)
+    synthseg = sitk.GetArrayFromImage(phantom['synthseg'])
+    atlas = sitk.GetArrayFromImage(phantom['atlas'])
+    brainmask = sitk.GetArrayFromImage(phantom['brainmask'])
+    wmh = sitk.GetArrayFromImage(phantom['wmh'])
+    voxel_size = float(np.prod(spacing))
+
+    timings = {}
+    (vent_dist_img, cortex_dist_img), timings['distance_maps'] = _measure(distance_maps, phantom['synthseg'], use_spacing=True)
+    vent_dist = sitk.GetArrayFromImage(vent_dist_img)
+    cortex_dist = sitk.GetArrayFromImage(cortex_dist_img)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        (rings, norm_dist), timings['pv_distance_rings'] = _measure(compute_pv_distance_rings, vent_dist, cortex_dist, brainmask == 1)
+    brainroi, timings['combined_regions'] = _measure(create_combined_regions, atlas, rings)
+    fused, timings['bullseye_labels'] = _measure(bullseye_labels, norm_dist, brainmask == 1, atlas)
+    wmh_parc, timings['parcellate_from_brainroi'] = _measure(parcellate_from_brainroi, brainroi, wmh, voxel_size)
+    data = {'brainroi': brainroi, 'wmh': wmh, 'atlas': atlas, 'synthseg': synthseg, 'brainmask': brainmask, 'voxel_size': voxel_size}
+    volumes, timings['all_brain_volumes'] = _measure(get_all_brain_volumes, data)
+    (lesions, lesion_regions), timings['lesion_stats'] = _measure(lesion_stats, wmh, brainroi, voxel_size)
+
+    if not np.array_equal(fused, brainroi):
+        raise AssertionError("bullseye_labels does not match create_combined_regions")
+
+    summary = {
+        'shape': list(synthseg.shape),
+        'ring_counts': label_histogram(rings).tolist(),
+        'roi_counts': label_histogram(brainroi).tolist(),
+        'wmh_parcellated_volume': float(sum(wmh_parc.values())),
+        'all_volumes_total': float(sum(volumes.values())),
+        'lesion_region_counts': lesion_regions['n_lesions'].tolist(),
+    }
+    return timings, summary
+
+def check_summary(summary, reference, rtol=1e-3):
+    """returns a list of the differences between an output summary and its reference (empty if they agree)"""
+    problems = []
+    for key, expected in reference.items():
+        actual = summary.get(key)
+        if key == 'shape' or np.shape(actual) != np.shape(expected):
+            matches = actual == expected
+        else:
+            matches = np.allclose(actual, expected, rtol=rtol, atol=1)
+        if not matches:
+            problems.append(f"{key}: expected {expected}, got {actual}")
+    return problems
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--configs', nargs='+', default=list(PHANTOM_CONFIGS.keys()), choices=list(PHANTOM_CONFIGS.keys()), help="phantom configurations to run")
+    parser.add_argument('--spacing', nargs=3, type=float, default=None, help="run a single phantom at this voxel spacing (x y z) instead (not checked against references)")
+    parser.add_argument('-o', '--output', default=None, type=str, help="path of a json file to save the timings and summaries to")
+    parser.add_argument('--update_references', action='store_true', help="store the output summaries as the new references")
+
+    return parser
+
+def main(args):
+    configs = {'custom': tuple(args.spacing)} if args.spacing is not None else {name: PHANTOM_CONFIGS[name] for name in args.configs}
+
+    references = {}
+    if os.path.exists(REFERENCES_FILE):
+        with open(REFERENCES_FILE) as f:
+            references = json.load(f)
+
+    results = {}
+    failed = False
+    for name, spacing in configs.items():
+        timings, summary = run_benchmark(spacing)
+        results[name] = {'spacing': list(spacing), 'timings': timings, 'summary': summary}
+
+        print(f"\n{name}: spacing {spacing}, shape {summary['shape']}")
+        for stage, timing in timings.items():
+            print(f"  {stage:<28} {timing['wall_time_s']:8.3f} s {timing['peak_alloc_mb']:10.1f} MB")
+
+        if args.update_references and name != 'custom':
+            references[name] = summary
+        elif name in references:
+            problems = check_summary(summary, references[name])
+            failed |= len(problems) > 0
+            print("  outputs match the reference" if not problems else "  outputs differ from the reference:\n    " + "\n    ".join(problems))
+
+    if args.update_references:
+        with open(REFERENCES_FILE, "w") as f:
+            json.dump(references, f, indent=2)
+        print("updated references in: ", REFERENCES_FILE)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("saved benchmark results to: ", args.output)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    raise SystemExit(main(args))
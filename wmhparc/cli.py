@@ -0,0 +1,207 @@
+"""
+Subcommand command line interface to the pipeline stages:
+
+    python -m wmhparc.cli register     register the template to a subject image and warp the lobe atlas to it
+    python -m wmhparc.cli layers       compute the concentric layers (pvrings) from the SynthSeg output
+    python -m wmhparc.cli parcellate   combine the warped lobe atlas and the layers into the bullseye parcellation
+    python -m wmhparc.cli stats        WMH volumes of one or many existing bullseye parcellations
+    python -m wmhparc.cli lesions      lesion counts, size distribution and spanning lesions per region of an existing bullseye parcellation
+    python -m wmhparc.cli relayer      new layers and bullseye parcellation from a saved normalised distance map, e.g for another number of layers
+    python -m wmhparc.cli run          all the stages, takes the arguments of run_parcellation.py
+
+Each subcommand only imports the modules it needs, so e.g. stats does not load ANTs (or scipy).
+"""
+import os
+import argparse
+from wmhparc.registration_profiles import REGISTRATION_PROFILES
+
+def register(args):
+    from wmhparc.run_parcellation import register_and_apply
+    from wmhparc.utils import parse_label_maps
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    register_and_apply(
+        args.image, args.template, args.atlas, args.output_folder, image_mask=args.brainmask, template_mask=args.template_brainmask,
+        profile=args.registration_profile, threads=args.threads, random_seed=args.random_seed, crop_margin=args.crop_margin,
+        compression_level=args.compression_level, label_maps=parse_label_maps(args.label_maps),
+    )
+
+def layers(args):
+    from wmhparc.concentric_layers import postprocess_synthseg, create_norm_dist_file, create_norm_dist_file_from_synthseg, create_pv_rings_from_norm_dist, resolve_boundaries
+
+    boundaries = resolve_boundaries(args.layers, args.layer_boundaries)
+    os.makedirs(args.output_folder, exist_ok=True)
+    native_spacing = not args.resample_1mm_distances
+    if args.no_distance_maps:
+        norm_dist_file = create_norm_dist_file_from_synthseg(
+            args.image, args.synthseg, args.brainmask, args.output_folder, native_spacing=native_spacing, lean=args.lean_distances,
+            compression_level=args.compression_level,
+        )
+    else:
+        ventmap_outimage, cortexmap_outimage = postprocess_synthseg(
+            args.image, args.synthseg, args.output_folder, native_spacing=native_spacing, lean=args.lean_distances, brainmask=args.brainmask,
+            compression_level=args.compression_level,
+        )
+        norm_dist_file = create_norm_dist_file(args.image, ventmap_outimage, cortexmap_outimage, args.brainmask, args.output_folder, compression_level=args.compression_level)
+    create_pv_rings_from_norm_dist(norm_dist_file, boundaries, compression_level=args.compression_level)
+
+def parcellate(args):
+    from wmhparc.parcellate_image import save_brain_parcellation_image
+
+    save_brain_parcellation_image(args.lobe_atlas, args.pvrings, compression_level=args.compression_level, n_layers=args.layers)
+
+def relayer(args):
+    from wmhparc.concentric_layers import create_pv_rings_from_norm_dist, resolve_boundaries
+    from wmhparc.parcellate_image import save_brain_parcellation_image, calc_parc_stats
+
+    boundaries = resolve_boundaries(args.layers, args.layer_boundaries)
+    pv_rings_file = create_pv_rings_from_norm_dist(args.norm_dist, boundaries, compression_level=args.compression_level)
+    parc_file = save_brain_parcellation_image(args.lobe_atlas, pv_rings_file, compression_level=args.compression_level, n_layers=len(boundaries) + 1)
+    if args.wmh_seg is not None:
+        # the normalised distance map is on the grid of the subject image, so it gives the voxel size
+        df = calc_parc_stats(args.norm_dist, parc_file, args.wmh_seg, len(boundaries) + 1)
+        stats_file = parc_file.split(".nii")[0] + "_wmh_vols.csv"
+        df.to_csv(stats_file)
+        print("saved WMH volumes to: ", stats_file)
+
+def stats(args):
+    if args.manifest is None:
+        if args.image is None or args.parc is None or args.wmh_segs is None:
+            raise ValueError("--image, --parc and --wmh_segs are required without --manifest")
+        from wmhparc.run_stats import main as run_stats_main
+        return run_stats_main(args)
+
+    from wmhparc.parcellate_image import calc_parc_stats_multi
+    import pandas as pd
+
+    manifest = pd.read_csv(args.manifest)
+    missing = [column for column in ('image', 'parc', 'wmh_seg') if column not in manifest.columns]
+    if missing:
+        raise ValueError(f"manifest {args.manifest} is missing the columns {missing}")
+    if 'subject' not in manifest.columns:
+        manifest['subject'] = [parc.split(os.path.sep)[-1].split("_bullseye_parc")[0] for parc in manifest['parc']]
+
+    results = []
+    failures = 0
+    for row in manifest.to_dict('records'):
+        try:
+            df = calc_parc_stats_multi(row['image'], row['parc'], [row['wmh_seg']], thresholds=args.thresholds, n_layers=args.layers)
+        except Exception as e:
+            print(f"subject {row['subject']} failed: {e!r}")
+            failures += 1
+            continue
+        df.insert(0, 'subject', row['subject'])
+        results.append(df)
+
+    if results:
+        pd.concat(results, ignore_index=True).to_csv(args.output, index=False)
+        print("saved WMH volumes to: ", args.output)
+    print(f"{len(results)} subjects done, {failures} failed")
+    return 1 if failures else 0
+
+def lesions(args):
+    from wmhparc.lesion_stats import main as lesion_stats_main
+
+    return lesion_stats_main(args)
+
+def run(args):
+    from wmhparc.run_parcellation import construct_parser as run_parcellation_parser, main as run_parcellation_main
+
+    return run_parcellation_main(run_parcellation_parser().parse_args(args.arguments))
+
+def _add_output_arguments(parser):
+    parser.add_argument('--compression_level', default=None, type=int, choices=range(10), help="gzip level (1-9) of the output images, 0 to write uncompressed .nii files")
+
+def _add_layering_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--layers', default=None, type=int, help="number of equidistant concentric layers (default: 4)")
+    group.add_argument('--layer_boundaries', default=None, nargs='+', type=float, help="the normalised distance boundaries between the layers, e.g 0.2 0.5 0.8")
+
+def construct_parser():
+    parser = argparse.ArgumentParser(description="automated WMH bullseye parcellation")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    register_parser = subparsers.add_parser('register', help="register the template to the subject image and warp the lobe atlas to it")
+    register_parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical subject image of interest")
+    register_parser.add_argument('-t', '--template', required=True, type=str, help="path to the 73yr T1w template image")
+    register_parser.add_argument('-a', '--atlas', required=True, type=str, help="path to the brainlobe atlas")
+    register_parser.add_argument('-b', '--brainmask', default=None, type=str, help="path to the brainmask (ICV) file of the subject image")
+    register_parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
+    register_parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder for the transforms and the warped lobe atlas")
+    register_parser.add_argument('-p', '--registration_profile', default='default', choices=list(REGISTRATION_PROFILES.keys()), help="registration speed / accuracy profile")
+    register_parser.add_argument('--threads', default=None, type=int, help="number of ITK threads used for registration (default: all available)")
+    register_parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration, for reproducible runs")
+    register_parser.add_argument('--crop_margin', default=None, type=int, help="crop to the brainmask bounding box padded by this many voxels for registration and atlas warping")
+    register_parser.add_argument('--label_maps', default=None, nargs='+', type=str, help="other label maps in template space to warp along with the atlas in one pass, as name=path (saved as <image>_<name>)")
+    _add_output_arguments(register_parser)
+    register_parser.set_defaults(func=register)
+
+    layers_parser = subparsers.add_parser('layers', help="compute the concentric layers from the SynthSeg output")
+    layers_parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical image SynthSeg was run on")
+    layers_parser.add_argument('-s', '--synthseg', required=True, type=str, help="path to the SynthSeg output of the image")
+    layers_parser.add_argument('-b', '--brainmask', required=True, type=str, help="path to the brainmask (ICV) file of the image")
+    layers_parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder for the distance maps and layers")
+    layers_parser.add_argument('--resample_1mm_distances', action='store_true', help="compute the distance maps on a 1x1x1 reslice of the synthseg image")
+    layers_parser.add_argument('--lean_distances', action='store_true', help="compute the distance maps cropped to the brain, concurrently and as float32")
+    layers_parser.add_argument('--no_distance_maps', action='store_true', help="do not save the ventricle and cortex distance maps")
+    _add_layering_arguments(layers_parser)
+    _add_output_arguments(layers_parser)
+    layers_parser.set_defaults(func=layers)
+
+    parcellate_parser = subparsers.add_parser('parcellate', help="combine the lobe atlas and layers into the bullseye parcellation (saved next to the layers)")
+    parcellate_parser.add_argument('-l', '--lobe_atlas', required=True, type=str, help="path to the lobe atlas warped to the subject image")
+    parcellate_parser.add_argument('-r', '--pvrings', required=True, type=str, help="path to the concentric layers (pvrings) image")
+    parcellate_parser.add_argument('--layers', default=4, type=int, help="number of layers of the pvrings image (default: 4)")
+    _add_output_arguments(parcellate_parser)
+    parcellate_parser.set_defaults(func=parcellate)
+
+    stats_parser = subparsers.add_parser('stats', help="WMH volumes of existing bullseye parcellations")
+    stats_parser.add_argument('-i', '--image', default=None, type=str, help="path to the anatomical subject image the parcellation was computed for (used for the voxel size)")
+    stats_parser.add_argument('-p', '--parc', default=None, type=str, help="path to the bullseye_parc image of the subject")
+    stats_parser.add_argument('-w', '--wmh_segs', default=None, nargs='+', type=str, help="paths to one or more WMH segmentation or probability map files")
+    stats_parser.add_argument('-m', '--manifest', default=None, type=str, help="instead of -i, -p and -w, a csv with the columns image, parc, wmh_seg and optionally subject, all processed in one process")
+    stats_parser.add_argument('--thresholds', default=None, nargs='+', type=float, help="binarise each WMH map at each of these thresholds (voxels >= threshold)")
+    stats_parser.add_argument('--layers', default=4, type=int, help="number of concentric layers the parcellations were made with (default: 4)")
+    stats_parser.add_argument('-o', '--output', required=True, type=str, help="path of the output csv")
+    stats_parser.set_defaults(func=stats)
+
+    lesions_parser = subparsers.add_parser('lesions', help="lesion level statistics per region of an existing bullseye parcellation")
+    lesions_parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical subject image the parcellation was computed for (used for the voxel size)")
+    lesions_parser.add_argument('-p', '--parc', required=True, type=str, help="path to the bullseye_parc image of the subject")
+    lesions_parser.add_argument('-w', '--wmh_seg', required=True, type=str, help="path to the WMH segmentation (or probability map) file")
+    lesions_parser.add_argument('--layers', default=4, type=int, help="number of concentric layers the parcellation was made with (default: 4)")
+    lesions_parser.add_argument('--threshold', default=0.5, type=float, help="voxels of the WMH map >= threshold are lesion voxels")
+    lesions_parser.add_argument('--fully_connected', action='store_true', help="also connect lesion voxels that only share an edge or corner")
+    lesions_parser.add_argument('--size_bins', default=[10.0, 100.0, 1000.0], nargs='+', type=float, help="lesion volume boundaries (mm^3) of the size distribution")
+    lesions_parser.add_argument('-o', '--out_prefix', default=None, type=str, help="prefix of the output csv files (default: next to the parcellation)")
+    lesions_parser.set_defaults(func=lesions)
+
+    relayer_parser = subparsers.add_parser('relayer', help="new layers and bullseye parcellation from a saved normalised distance map (saved next to it)")
+    relayer_parser.add_argument('-n', '--norm_dist', required=True, type=str, help="path to the normalised distance (normdist) image of the subject")
+    relayer_parser.add_argument('-l', '--lobe_atlas', required=True, type=str, help="path to the lobe atlas warped to the subject image")
+    relayer_parser.add_argument('-w', '--wmh_seg', default=None, type=str, help="path to the WMH segmentation file, to also calculate the WMH volumes")
+    _add_layering_arguments(relayer_parser)
+    _add_output_arguments(relayer_parser)
+    relayer_parser.set_defaults(func=relayer)
+
+    # the arguments of run are parsed by the run_parcellation parser, see parse_args
+    run_parser = subparsers.add_parser('run', add_help=False, help="run all the stages (see run -h for the arguments, as for run_parcellation.py)")
+    run_parser.set_defaults(func=run)
+
+    return parser
+
+def parse_args(argv=None):
+    """parses the command line, the arguments after run are left unparsed in args.arguments for run_parcellation"""
+    parser = construct_parser()
+    args, arguments = parser.parse_known_args(argv)
+    if arguments and args.command != 'run':
+        parser.error(f"unrecognized arguments: {' '.join(arguments)}")
+    args.arguments = arguments
+    return args
+
+def main(args):
+    return args.func(args)
+
+if __name__ == '__main__':
+    args = parse_args()
+    raise SystemExit(main(args))
@@ -0,0 +1,81 @@
+"""
+Compare the registration profiles on a subject image.
+
+Runs the template registration and atlas warp with each profile and reports the runtime and the Dice overlap
+of each lobe in the warped atlas against the warped atlas of the default profile.
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from wmhparc.registration import REGISTRATION_PROFILES
+from wmhparc.run_parcellation import register_and_apply
+from wmhparc.parcellate_image import joint_label_histogram, regions
+from wmhparc.utils import load_image
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical subject image of interest (e.g T1w or FLAIR image)")
+    parser.add_argument('-b', '--brainmask', default=None, type=str, help="path to the brainmask (ICV) file of the subject image")
+    parser.add_argument('-t', '--template', required=True, type=str, help="path to the 73yr T1w template image")
+    parser.add_argument('-a', '--atlas', required=True, type=str, help="path to the brainlobe atlas")
+    parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
+    parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder, each profile is run in a subfolder named after it")
+    parser.add_argument('-p', '--profiles', nargs='+', default=list(REGISTRATION_PROFILES.keys()), choices=list(REGISTRATION_PROFILES.keys()), help="profiles to compare")
+    parser.add_argument('--threads', default=None, type=int, help="number of ITK threads used for registration")
+    parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration")
+
+    return parser
+
+def lobe_dice(atlas_a, atlas_b):
+    """dice overlap of each lobe region between two lobe atlas arrays"""
+    joint = joint_label_histogram(atlas_a, atlas_b)
+    size = max(regions) + 1
+    joint = np.pad(joint, ((0, max(0, size - joint.shape[0])), (0, max(0, size - joint.shape[1]))))
+    counts_a = joint.sum(axis=1)
+    counts_b = joint.sum(axis=0)
+    results = {}
+    for region_id, region_name in regions.items():
+        total = counts_a[region_id] + counts_b[region_id]
+        results[f'dice_{region_name}'] = 2 * joint[region_id, region_id] / total if total > 0 else np.nan
+    return results
+
+def compare_profiles(image, template, atlas, output_folder, brainmask=None, template_brainmask=None, profiles=None, threads=None, random_seed=None):
+    """
+    returns a dataframe with one row per profile, holding the runtime and per lobe dice against the default profile.
+    """
+    profiles = list(REGISTRATION_PROFILES.keys()) if profiles is None else list(profiles)
+    if 'default' not in profiles:
+        profiles = ['default'] + profiles
+
+    atlases = {}
+    runtimes = {}
+    for profile in profiles:
+        profile_folder = os.path.join(output_folder, profile)
+        os.makedirs(profile_folder, exist_ok=True)
+        start = time.perf_counter()
+        atlas_file = register_and_apply(image, template, atlas, profile_folder, image_mask=brainmask, template_mask=template_brainmask, profile=profile, threads=threads, random_seed=random_seed)
+        runtimes[profile] = time.perf_counter() - start
+        atlases[profile] = load_image(atlas_file)
+
+    rows = []
+    for profile in profiles:
+        dice = lobe_dice(atlases[profile], atlases['default'])
+        rows.append({'profile': profile, 'runtime_s': runtimes[profile], 'mean_dice': np.nanmean(list(dice.values())), **dice})
+    return pd.DataFrame(rows)
+
+def main(args):
+    df = compare_profiles(
+        args.image, args.template, args.atlas, args.output_folder, brainmask=args.brainmask, template_brainmask=args.template_brainmask,
+        profiles=args.profiles, threads=args.threads, random_seed=args.random_seed,
+    )
+    print(df[['profile', 'runtime_s', 'mean_dice']].to_string(index=False))
+    out_path = os.path.join(args.output_folder, "registration_profiles.csv")
+    df.to_csv(out_path, index=False)
+    print("saved profile comparison to: ", out_path)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,8 +1,7 @@
-import subprocess
 import SimpleITK as sitk
-from scipy.ndimage import distance_transform_edt
+from concurrent.futures import ThreadPoolExecutor
 import os
-from wmhparc.utils import resample_match_if_necessary, fileending, load_image, save_manipulated_sitk_image_array
+from wmhparc.utils import fileending, output_ending, write_image, load_image, read_image, read_header, save_manipulated_sitk_image_array, image_from_array, resample_to_reference, resample_to_spacing, spacings_match, same_grid
 import numpy as np
 
 
@@ -18,6 +17,96 @@ CORTEX_3 = 8
 CORTEX_4 = 47
 CORTEX_PARC = 1000
 
+# normalised distance boundaries between the concentric layers (ventricles = 0, cortex = 1)
+RING_BOUNDARIES = (0.25, 0.5, 0.75)
+
+
+# voxels of padding around the brain bounding box when cropping for the distance transforms
+CROP_MARGIN = 3
+
+# value of the saved distance maps outside the box of lean distance maps (nan is read back as 0 by the ITK nifti reader,
+# which would read as lying on the ventricles / cortex)
+DIST_OUTSIDE = -1.0
+
+def brain_bounding_box(foreground, margin=CROP_MARGIN):
+    """
+    returns the tuple of slices of the bounding box of a boolean foreground array, padded by margin voxels.
+    the full array is returned if the foreground is empty.
+    """
+    box = []
+    for axis in range(foreground.ndim):
+        present = np.flatnonzero(foreground.any(axis=tuple(a for a in range(foreground.ndim) if a != axis)))
+        if len(present) == 0:
+            return tuple(slice(None) for _ in range(foreground.ndim))
+        box.append(slice(max(present[0] - margin, 0), min(present[-1] + margin + 1, foreground.shape[axis])))
+    return tuple(box)
+
+def distance_maps(synthseg_img, use_spacing=False, lean=False, mask_img=None):
+    """
+    extracts the ventricles segmentation and the cortex segmentation from a sitk synth_seg image
+    and creates a euclidian distance map from each voxel to the ventricles and to the cortex.
+    returns the (ventricle, cortex) distance maps as float32 sitk images on the synthseg grid (the on disk
+    pixel type of the distance maps, so layers computed in memory and from saved maps agree).
+
+    use_spacing: if True distances are computed in mm at the native voxel spacing of the image,
+    otherwise in voxels, which requires the image to be approx 1x1x1.
+    lean: if True the transforms are computed on the bounding box of the synthseg foreground (and mask_img, a sitk
+    brainmask on the same grid, if given) and concurrently. The ventricles and cortex lie inside
+    the box so the distances there are unchanged, voxels outside the box are set to nan.
+    """
+    # imported here so that only the distance maps, not e.g the stats, pay for loading scipy
+    from scipy.ndimage import distance_transform_edt
+
+    spacing = synthseg_img.GetSpacing()
+    sampling = None
+    if use_spacing:
+        # sitk spacing is (x, y, z), the array is indexed (z, y, x)
+        sampling = spacing[::-1]
+    elif not ((0.95 <= spacing[0] <= 1.05) and (0.95 <= spacing[1] <= 1.05) and (0.95 <= spacing[2] <= 1.05)):
+        raise ValueError(f"image spacing must be approx (1, 1, 1) to compute distance map, not {spacing}")
+
+    synthseg = sitk.GetArrayFromImage(synthseg_img)
+    def ventricles(seg):
+        return (seg == VENTRICLE_1) | (seg == VENTRICLE_2) | (seg == VENTRICLE_INFERIOR_L) | (seg == VENTRICLE_INFERIOR_R)
+    def cortex(seg):
+        return (seg == CORTEX_1) | (seg == CORTEX_2) | (seg == CORTEX_3) | (seg == CORTEX_4) | (seg > CORTEX_PARC)
+
+    if not lean:
+        def extract_distance(condition):
+            condition = condition.astype(np.float32)
+            distance_map = distance_transform_edt(1 - condition, sampling=sampling)
+            return image_from_array(distance_map.astype(np.float32), synthseg_img)
+
+        return extract_distance(ventricles(synthseg)), extract_distance(cortex(synthseg))
+
+    foreground = synthseg > 0
+    if mask_img is not None:
+        foreground |= sitk.GetArrayFromImage(mask_img) != 0
+    box = brain_bounding_box(foreground)
+    del foreground
+    cropped = synthseg[box]
+
+    def extract_distance_cropped(condition):
+        distance_map = np.full(synthseg.shape, np.nan, dtype=np.float32)
+        distance_map[box] = distance_transform_edt(~condition, sampling=sampling)
+        return image_from_array(distance_map, synthseg_img)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        vent_dist, cortex_dist = pool.map(extract_distance_cropped, [ventricles(cropped), cortex(cropped)])
+    return vent_dist, cortex_dist
+
+def saved_distance_image(dist_img):
+    """the sitk distance map to write to disk, with the nan outside the box of lean distance maps set to DIST_OUTSIDE"""
+    dist = sitk.GetArrayViewFromImage(dist_img)
+    outside = np.isnan(dist)
+    if not outside.any():
+        return dist_img
+    return image_from_array(np.where(outside, np.float32(DIST_OUTSIDE), dist).astype(np.float32), dist_img)
+
+def load_distance_map(filepath):
+    """voxel array of a saved distance map, with DIST_OUTSIDE set back to nan (as the distance maps are in memory)"""
+    dist = load_image(filepath)
+    return np.where(dist < 0, np.float32(np.nan), dist).astype(np.float32)
 
 def create_ventricle_distance_map(synthseg_file, outfile_ventricle, outfile_cortex):
     """
@@ -25,48 +114,67 @@ def create_ventricle_distance_map(synthseg_file, outfile_ventricle, outfile_cort
     and creates a euclidian distance map from each voxel to the ventricles.
     This distance map is then saved under the name out_file
     """
-    
-    synthseg_img = sitk.ReadImage(synthseg_file)
-    
-    spacing = synthseg_img.GetSpacing()
-    if not ((0.95 <= spacing[0] <= 1.05) and (0.95 <= spacing[1] <= 1.05) and (0.95 <= spacing[2] <= 1.05)):
-        raise ValueError(f"image spacing must be approx (1, 1, 1) to compute distance map, not {spacing}")
-        
-    def extract_distance(condition, outfile):
-        condition = condition.astype(np.float32)
-        distance_map = distance_transform_edt(1 - condition)
-        save_manipulated_sitk_image_array(synthseg_img, distance_map, outfile)
-    
-    synthseg = sitk.GetArrayFromImage(synthseg_img)
-    vent_dist = extract_distance((synthseg == VENTRICLE_1) | (synthseg == VENTRICLE_2) | (synthseg == VENTRICLE_INFERIOR_L) | (synthseg == VENTRICLE_INFERIOR_R), outfile_ventricle)
-    extract_distance((synthseg == CORTEX_1) | (synthseg == CORTEX_2) | (synthseg == CORTEX_3) | (synthseg == CORTEX_4) | (synthseg > CORTEX_PARC), outfile_cortex)
+    vent_dist, cortex_dist = distance_maps(read_image(synthseg_file))
+    sitk.WriteImage(vent_dist, outfile_ventricle)
+    sitk.WriteImage(cortex_dist, outfile_cortex)
+
+def distance_maps_in_image_space(in_img, synthseg_img, native_spacing=True, lean=False, mask_img=None):
+    """
+    in memory version of postprocess_synthseg: takes the sitk synthseg image, creates the ventricle distance
+    and cortex distance maps in the space of the sitk image synthseg was run on (only its grid is used, so
+    in_img can also be its header, see read_header).
+    returns the (ventricle, cortex) distance maps as sitk images.
+
+    native_spacing: if True the synthseg labels are (nearest neighbour) resampled to the image grid if needed and the
+    distances computed there in mm. Otherwise the labels are resliced to 1x1x1, the distances computed in voxels
+    and trilinearly resampled back to the image grid.
+    lean, mask_img: crop, float32 and concurrent transforms, see distance_maps. mask_img is a sitk brainmask
+    (e.g on the grid of in_img) included in the box, so the distances are defined over all of it.
+    """
+    if native_spacing:
+        if not same_grid(in_img, synthseg_img):
+            synthseg_img = resample_to_reference(synthseg_img, in_img, use_nearest_neighbor=True)
+        return distance_maps(synthseg_img, use_spacing=True, lean=lean, mask_img=mask_img)
+
+    # ensure the synthseg image is in 1x1x1 space
+    if not np.allclose(synthseg_img.GetSpacing(), 1, rtol=0, atol=1e-6):
+        synthseg_img = resample_to_spacing(synthseg_img, (1, 1, 1), use_nearest_neighbor=True)
+
+    if lean and mask_img is not None:
+        # the box keeps CROP_MARGIN mm around the brainmask, so the trilinear resampling back does not spread the nan
+        # outside it into the brainmask
+        mask_img = resample_to_reference(mask_img, synthseg_img, use_nearest_neighbor=True)
+    vent_dist, cortex_dist = distance_maps(synthseg_img, lean=lean, mask_img=mask_img if lean else None)
+
+    # resample the output images back to the space of the in_image
+    if not spacings_match(in_img.GetSpacing(), vent_dist.GetSpacing()):
+        vent_dist = resample_to_reference(vent_dist, in_img)
+        cortex_dist = resample_to_reference(cortex_dist, in_img)
+
+    return vent_dist, cortex_dist
 
-def postprocess_synthseg(in_image, synthseg_outimage, out_folder):
+def postprocess_synthseg(in_image, synthseg_outimage, out_folder, native_spacing=True, lean=False, brainmask=None, compression_level=None):
     """
     takes the synthseg output, creates the ventricle distance and cortex distance map
     and then resamples all three images to the space of the original input image synthseg was run on.
 
     in_image: the image that synthseg was run on
     out_folder: the path to the derivatives folder where the synthseg imgage is stored and the distance maps will be created.
+    native_spacing: compute the distances at the voxel spacing of in_image instead of at 1x1x1 (see distance_maps_in_image_space)
+    lean: crop to the brain (synthseg and the optional brainmask file), float32 and concurrent transforms (see distance_maps)
+    compression_level: gzip level of the outputs, 0 to write uncompressed .nii files (default: the ending of in_image)
     """
     in_imagename = in_image.split(".nii")[0].split("/")[-1]
-    in_filetype = fileending(in_image)
+    in_filetype = output_ending(compression_level, fileending(in_image))
     ventmap_outimage = os.path.join(out_folder, in_imagename + "_ventdist" + in_filetype)
     cortexmap_outimage = os.path.join(out_folder, in_imagename + "_cortexdist" + in_filetype)
 
-    # ensure the synthseg image is in 1x1x1 space
-    command = [
-        "mri_convert", "-vs", "1", "1", "1", "-rt", "nearest",
-        synthseg_outimage, ventmap_outimage
-    ]
-    _ = subprocess.call(command, stdout=subprocess.DEVNULL)
-    
-    # create ventricle distance map imag
-    create_ventricle_distance_map(ventmap_outimage, ventmap_outimage, cortexmap_outimage)
-
-    # resample the output images back to the space of the in_image
-    resample_match_if_necessary(in_image, ventmap_outimage, use_nearest_neighbor=False)
-    resample_match_if_necessary(in_image, cortexmap_outimage, use_nearest_neighbor=False)
+    # distance maps computed in memory in the space of the in_image
+    # only the grid of the in_image is needed, so just its header is read
+    mask_img = read_image(brainmask) if (lean and brainmask is not None) else None
+    vent_dist, cortex_dist = distance_maps_in_image_space(read_header(in_image), read_image(synthseg_outimage), native_spacing=native_spacing, lean=lean, mask_img=mask_img)
+    write_image(saved_distance_image(vent_dist), ventmap_outimage, kind='distance', compression_level=compression_level)
+    write_image(saved_distance_image(cortex_dist), cortexmap_outimage, kind='distance', compression_level=compression_level)
 
     return ventmap_outimage, cortexmap_outimage
 
@@ -76,49 +184,189 @@ calculates the ventricle rings (rings of distance from the ventricles for a brai
 includes function to load the distance images from disk, calculate the rings and save result to disk.
 """
 
-def combined_roi_array(lobes):
-    arr = np.zeros(lobes[0].shape)
-    
-    for idx, lobe in enumerate(lobes):
-        arr[lobe] = idx + 1
-        
-    return arr
+# value of the saved normalised distance map outside the brainmask (nan is read back as 0 by the ITK nifti reader)
+NORM_DIST_OUTSIDE = -1.0
+
+def layer_boundaries(n_layers):
+    """normalised distance boundaries of n_layers equidistant concentric layers"""
+    if n_layers < 1:
+        raise ValueError(f"the number of layers must be at least 1, not {n_layers}")
+    return tuple(i / n_layers for i in range(1, n_layers))
 
-def compute_pv_distance_rings(vent_dist, cortex_dist, brainmask):
+def check_boundaries(boundaries):
+    """checks the layer boundaries are increasing and within (0, 1), returns them as a tuple"""
+    boundaries = tuple(float(b) for b in boundaries)
+    if any(not 0 < b < 1 for b in boundaries) or any(a >= b for a, b in zip(boundaries, boundaries[1:])):
+        raise ValueError(f"layer boundaries must be increasing and between 0 and 1, not {boundaries}")
+    return boundaries
+
+def resolve_boundaries(n_layers=None, boundaries=None):
+    """layer boundaries from either a number of equidistant layers or explicit boundaries, RING_BOUNDARIES if neither is given"""
+    if n_layers is not None and boundaries is not None:
+        raise ValueError("only one of the number of layers and the layer boundaries can be given")
+    if boundaries is not None:
+        return check_boundaries(boundaries)
+    if n_layers is not None:
+        return layer_boundaries(n_layers)
+    return RING_BOUNDARIES
+
+def layering_suffix(boundaries):
+    """
+    filename suffix of the outputs of a layering: '' for the default RING_BOUNDARIES, _<n>layers for n equidistant
+    layers and _layers-<b1>-<b2>... for any other boundaries.
+    """
+    boundaries = check_boundaries(boundaries)
+    if len(boundaries) == len(RING_BOUNDARIES) and np.allclose(boundaries, RING_BOUNDARIES):
+        return ""
+    if np.allclose(boundaries, layer_boundaries(len(boundaries) + 1)):
+        return f"_{len(boundaries) + 1}layers"
+    return "_layers-" + "-".join(f"{b:g}" for b in boundaries)
+
+def ring_labels(norm_dist, brainmask, boundaries=RING_BOUNDARIES):
+    """
+    bins the normalised distance into the concentric layers 1..len(boundaries)+1 in a uint8 array.
+    voxels outside the brainmask (or where the normalised distance is undefined) are labelled 0.
+    brainmask may be None if the normalised distance is already negative outside the brain (see norm_dist_image).
+    """
+    out = np.ones(norm_dist.shape, dtype=np.uint8)
+    for boundary in boundaries:
+        out += norm_dist >= boundary
+    if brainmask is None:
+        out *= norm_dist >= 0
+    else:
+        out *= brainmask & (norm_dist == norm_dist)
+    return out
+
+def compute_pv_distance_rings(vent_dist, cortex_dist, brainmask, boundaries=RING_BOUNDARIES):
     norm_dist = vent_dist / (vent_dist + cortex_dist)
-    ring1 = (norm_dist < 0.25) & brainmask
-    ring2 = (norm_dist >= 0.25) & (norm_dist < 0.5) & brainmask
-    ring3 = (norm_dist >= 0.5) & (norm_dist < 0.75) & brainmask
-    ring4 = (norm_dist >= 0.75) & brainmask
-    
-    rings = combined_roi_array([ring1, ring2, ring3, ring4])
+    rings = ring_labels(norm_dist, brainmask, boundaries)
     
     return rings, norm_dist
 
-def create_pv_dist_ring_file(in_image, synthseg_outimage, ventmap_outimage, cortexmap_outimage, brainmask_outimage, out_folder):
+def norm_dist_array(vent_dist_img, cortex_dist_img):
+    """the normalised distance (0 at the ventricles, 1 at the cortex) array of the sitk vent and cortex dist maps"""
+    return sitk.GetArrayViewFromImage(vent_dist_img) / (sitk.GetArrayViewFromImage(vent_dist_img) + sitk.GetArrayViewFromImage(cortex_dist_img))
+
+def pv_dist_ring_image(vent_dist_img, cortex_dist_img, brainmask_img, reference_img, boundaries=RING_BOUNDARIES):
+    """
+    in memory version of create_pv_dist_ring_file: takes the sitk vent and cortex dist maps and brainmask
+    and returns the pv ring map as a sitk image with the metadata of reference_img, along with the normalised distance array.
+    """
+    vent_dist = sitk.GetArrayFromImage(vent_dist_img)
+    cortex_dist = sitk.GetArrayFromImage(cortex_dist_img)
+    brainmask = sitk.GetArrayFromImage(brainmask_img) == 1
+
+    pv_distance_rings, norm_dist = compute_pv_distance_rings(vent_dist, cortex_dist, brainmask, boundaries)
+
+    return image_from_array(pv_distance_rings, reference_img), norm_dist
+
+def norm_dist_image(norm_dist, brainmask, reference_img):
+    """
+    the normalised distance array as a sitk image with the metadata of reference_img, set to NORM_DIST_OUTSIDE
+    outside the brainmask and where it is undefined
+    """
+    norm_dist = np.where(brainmask & (norm_dist == norm_dist), norm_dist, NORM_DIST_OUTSIDE).astype(np.float32)
+    return image_from_array(norm_dist, reference_img)
+
+def create_pv_dist_ring_file(in_image, synthseg_outimage, ventmap_outimage, cortexmap_outimage, brainmask_outimage, out_folder, compression_level=None, boundaries=RING_BOUNDARIES):
     """
     takes the vent and cortex dist maps, creates the pv ring maps
-    save to disk as a file name pvrings, copying the metadata from the original synthseg image
+    save to disk as a file name pvrings, copying the metadata from the distance maps
 
     in_image: the image that synthseg was run on
     out_folder: the path to the derivatives folder where the synthseg imgage is stored and the distance maps will be created.
+    compression_level: gzip level of the output, 0 to write an uncompressed .nii file (default: the ending of in_image)
+    boundaries: normalised distance boundaries between the layers, the file name has the layering_suffix of non default boundaries
     """
     in_imagename = in_image.split(".nii")[0].split("/")[-1]
-    in_filetype = fileending(in_image)
+    in_filetype = output_ending(compression_level, fileending(in_image))
 
-    pvrings_outimage = os.path.join(out_folder, in_imagename + "_pvrings" + in_filetype)
+    pvrings_outimage = os.path.join(out_folder, in_imagename + "_pvrings" + layering_suffix(boundaries) + in_filetype)
     
-    synthseg_itk_img = sitk.ReadImage(synthseg_outimage)
-    vent_dist = load_image(ventmap_outimage)
-    cortex_dist = load_image(cortexmap_outimage)
+    # the distance maps are on the grid of the in_image, so their metadata is used for the rings
+    vent_dist_img = read_header(ventmap_outimage)
+    vent_dist = load_distance_map(ventmap_outimage)
+    cortex_dist = load_distance_map(cortexmap_outimage)
     brainmask = load_image(brainmask_outimage) == 1
     
-    pv_distance_rings, _ = compute_pv_distance_rings(vent_dist, cortex_dist, brainmask)
+    pv_distance_rings, _ = compute_pv_distance_rings(vent_dist, cortex_dist, brainmask, boundaries)
     
-    save_manipulated_sitk_image_array(synthseg_itk_img, pv_distance_rings, pvrings_outimage)
+    save_manipulated_sitk_image_array(vent_dist_img, pv_distance_rings, pvrings_outimage, kind='label', compression_level=compression_level)
+
+    print("saved concentric layers segmentation to: ", pvrings_outimage)
+
+    return pvrings_outimage
+
+def create_pv_rings_file(in_image, synthseg_outimage, brainmask_outimage, out_folder, native_spacing=True, lean=False, compression_level=None, boundaries=RING_BOUNDARIES):
+    """
+    postprocess_synthseg and create_pv_dist_ring_file in one step, without writing the distance maps to disk:
+    the distance maps are computed in memory and only the pv ring map is saved.
+    returns the path of the pv ring map.
+    """
+    in_imagename = in_image.split(".nii")[0].split("/")[-1]
+    pvrings_outimage = os.path.join(out_folder, in_imagename + "_pvrings" + layering_suffix(boundaries) + output_ending(compression_level, fileending(in_image)))
+
+    brainmask_img = read_image(brainmask_outimage)
+    vent_dist_img, cortex_dist_img = distance_maps_in_image_space(
+        read_header(in_image), read_image(synthseg_outimage), native_spacing=native_spacing, lean=lean, mask_img=brainmask_img if lean else None,
+    )
+    pv_rings_img, _ = pv_dist_ring_image(vent_dist_img, cortex_dist_img, brainmask_img, vent_dist_img, boundaries)
+    write_image(pv_rings_img, pvrings_outimage, kind='label', compression_level=compression_level)
 
     print("saved concentric layers segmentation to: ", pvrings_outimage)
 
     return pvrings_outimage
 
+def _norm_dist_path(in_image, out_folder, compression_level):
+    in_imagename = in_image.split(".nii")[0].split("/")[-1]
+    return os.path.join(out_folder, in_imagename + "_normdist" + output_ending(compression_level, fileending(in_image)))
+
+def create_norm_dist_file(in_image, ventmap_outimage, cortexmap_outimage, brainmask_outimage, out_folder, compression_level=None):
+    """
+    takes the vent and cortex dist maps and saves the normalised distance (0 at the ventricles, 1 at the cortex and
+    NORM_DIST_OUTSIDE outside the brainmask) as normdist, from which the layers for any boundaries can be made with create_pv_rings_from_norm_dist.
+    returns the path of the normalised distance map.
+    """
+    norm_dist_outimage = _norm_dist_path(in_image, out_folder, compression_level)
+
+    vent_dist_img = read_header(ventmap_outimage)
+    vent_dist = load_distance_map(ventmap_outimage)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm_dist = vent_dist / (vent_dist + load_distance_map(cortexmap_outimage))
+    write_image(norm_dist_image(norm_dist, load_image(brainmask_outimage) == 1, vent_dist_img), norm_dist_outimage, kind='distance', compression_level=compression_level)
+
+    print("saved normalised distance map to: ", norm_dist_outimage)
+    return norm_dist_outimage
 
+def create_norm_dist_file_from_synthseg(in_image, synthseg_outimage, brainmask_outimage, out_folder, native_spacing=True, lean=False, compression_level=None):
+    """
+    postprocess_synthseg and create_norm_dist_file in one step: the distance maps are computed in memory and only the
+    normalised distance map is saved. returns its path.
+    """
+    norm_dist_outimage = _norm_dist_path(in_image, out_folder, compression_level)
+
+    brainmask_img = read_image(brainmask_outimage)
+    vent_dist_img, cortex_dist_img = distance_maps_in_image_space(
+        read_header(in_image), read_image(synthseg_outimage), native_spacing=native_spacing, lean=lean, mask_img=brainmask_img if lean else None,
+    )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vent_dist = sitk.GetArrayFromImage(vent_dist_img)
+        norm_dist = vent_dist / (vent_dist + sitk.GetArrayFromImage(cortex_dist_img))
+    write_image(norm_dist_image(norm_dist, sitk.GetArrayFromImage(brainmask_img) == 1, vent_dist_img), norm_dist_outimage, kind='distance', compression_level=compression_level)
+
+    print("saved normalised distance map to: ", norm_dist_outimage)
+    return norm_dist_outimage
+
+def create_pv_rings_from_norm_dist(norm_dist_file, boundaries=RING_BOUNDARIES, compression_level=None):
+    """
+    creates the pv ring map for the given layer boundaries from a saved normalised distance map (see create_norm_dist_file),
+    saved next to it as pvrings<layering_suffix>. returns the path of the pv ring map.
+    """
+    pvrings_outimage = norm_dist_file.rsplit("_normdist", 1)[0] + "_pvrings" + layering_suffix(boundaries) + output_ending(compression_level, fileending(norm_dist_file))
+
+    norm_dist_img = read_image(norm_dist_file)
+    rings = ring_labels(sitk.GetArrayViewFromImage(norm_dist_img), None, boundaries)
+    save_manipulated_sitk_image_array(norm_dist_img, rings, pvrings_outimage, kind='label', compression_level=compression_level)
+
+    print("saved concentric layers segmentation to: ", pvrings_outimage)
+    return pvrings_outimage
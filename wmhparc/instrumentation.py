@@ -0,0 +1,128 @@
+"""
+Per stage timing and resource instrumentation of a pipeline run.
+
+A RunReport records, for each stage of a subject's run, the wall time, cpu time, peak resident memory and bytes
+read and written, and is written out as a json run report. An optional profiler hook is run around each stage.
+"""
+import os
+import json
+import time
+import resource
+import cProfile
+from contextlib import contextmanager, nullcontext
+from wmhparc.utils import read_header
+
+def _read_proc_io():
+    """bytes read and written by this process (linux only, None elsewhere)"""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+# peak resident memory (MB) reached so far by each stage being measured, outermost first. the peak is reset for the
+# whole process when a stage starts, so the peak of the stages it is nested in is taken first
+_open_stage_peaks = []
+
+def _reset_peak_rss():
+    """resets the peak resident memory of this process (linux only), returns whether it was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is in kB on linux (bytes on macOS), and never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def image_info(filepath):
+    """size and spacing of an image, read from the header only"""
+    header = read_header(filepath)
+    return {'size': list(header.GetSize()), 'spacing': list(header.GetSpacing())}
+
+def cprofile_hook(output_folder):
+    """profiler hook for RunReport that saves a cProfile of each stage to output_folder/<stage>.prof"""
+    os.makedirs(output_folder, exist_ok=True)
+
+    @contextmanager
+    def profile_stage(stage):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(output_folder, stage + ".prof"))
+    return profile_stage
+
+def measure(report, name, **info):
+    """report.stage(name) if a RunReport is given, otherwise a context manager that does nothing"""
+    return report.stage(name, **info) if report is not None else nullcontext({})
+
+class RunReport:
+    """
+    subject: name of the subject the run is for
+    profiler: optional callable taking a stage name and returning a context manager that is run around the stage
+    """
+    def __init__(self, subject, profiler=None, **info):
+        self.subject = subject
+        self.profiler = profiler
+        self.info = info
+        self.stages = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        context manager recording the resources used by the code run inside it as a stage.
+        yields the stage record, so extra information can be added to it.
+        """
+        record = {'stage': name, **info}
+        if _open_stage_peaks:
+            current_peak = _peak_rss_mb()
+            _open_stage_peaks[:] = [max(peak, current_peak) for peak in _open_stage_peaks]
+        peak_rss_scope = 'stage' if _reset_peak_rss() else 'process'
+        _open_stage_peaks.append(0.0)
+        io_start = _read_proc_io()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            with (self.profiler(name) if self.profiler is not None else nullcontext()):
+                yield record
+        finally:
+            record['wall_time_s'] = time.perf_counter() - wall_start
+            record['cpu_time_s'] = time.process_time() - cpu_start
+            record['peak_rss_mb'] = max(_open_stage_peaks.pop(), _peak_rss_mb())
+            record['peak_rss_scope'] = peak_rss_scope
+            io_end = _read_proc_io()
+            if io_start is not None and io_end is not None:
+                record['bytes_read'] = io_end[0] - io_start[0]
+                record['bytes_written'] = io_end[1] - io_start[1]
+            self.stages.append(record)
+
+    def skipped(self, name, **info):
+        """records a stage that was not run (e.g because its outputs were cached)"""
+        self.stages.append({'stage': name, 'skipped': True, **info})
+
+    def to_dict(self):
+        return {
+            'subject': self.subject,
+            **self.info,
+            'total_wall_time_s': time.perf_counter() - self.start,
+            'stages': self.stages,
+        }
+
+    def write(self, filepath):
+        with open(filepath, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print("saved run report to: ", filepath)
@@ -0,0 +1,181 @@
+"""
+Lesion level WMH statistics per bullseye region.
+
+The WMH segmentation is labelled into connected components (lesions) once, and every per lesion and per region
+statistic is derived from the (lesion, region) overlap counts of the lesion voxels, so the cost grows with the
+number of WMH voxels rather than with the number of lesions or regions.
+
+A lesion is counted in every region it overlaps, and assigned to the region holding most of its voxels for the
+size statistics. Lesions overlapping more than one region are spanning lesions.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from wmhparc.utils import load_image, read_header
+from wmhparc.parcellate_image import brain_roi_table, _label_index, N_LAYERS
+
+# lesion volume (mm^3) boundaries of the lesion size bins
+LESION_SIZE_BINS = (10.0, 100.0, 1000.0)
+
+def label_lesions(wmh, threshold=0.5, fully_connected=False):
+    """
+    labels the connected components of the wmh voxels >= threshold.
+    fully_connected: also connect voxels that only share an edge or corner (26 instead of 6 connectivity)
+    returns (lesions, n_lesions): an array of the lesion ids 1..n_lesions (0 outside the lesions) and the number of lesions
+    """
+    components = sitk.ConnectedComponentImageFilter()
+    components.SetFullyConnected(fully_connected)
+    lesions = components.Execute(sitk.GetImageFromArray((np.asarray(wmh) >= threshold).astype(np.uint8)))
+    return sitk.GetArrayFromImage(lesions), components.GetObjectCount()
+
+def lesion_region_overlap(lesions, brainroi, n_rois):
+    """
+    voxel counts of the overlaps between the lesions and the regions of brainroi, from the lesion voxels only.
+    region ids outside 1..n_rois-1 count as region 0 (outside the parcellation).
+    returns (lesion ids, region ids, voxel counts) of each overlapping (lesion, region) pair, sorted by lesion then region
+    """
+    voxels = np.flatnonzero(lesions)
+    lesion = np.asarray(lesions).ravel()[voxels].astype(np.intp)
+    roi, keep = _label_index(np.asarray(brainroi).ravel()[voxels])
+    valid = roi < n_rois
+    if keep is not None:
+        valid &= keep
+    roi[~valid] = 0
+
+    pairs, counts = np.unique(lesion * n_rois + roi, return_counts=True)
+    return pairs // n_rois, pairs % n_rois, counts
+
+def _size_bin_names(size_bins):
+    edges = [f"{edge:g}" for edge in size_bins]
+    return [f"lt{edges[0]}mm3"] + [f"{low}-{high}mm3" for low, high in zip(edges, edges[1:])] + [f"ge{edges[-1]}mm3"]
+
+def _grouped_size_stats(groups, sizes, n_groups, size_bins):
+    """count, total, mean, median, max and size bin counts of the sizes of each group 0..n_groups-1"""
+    count = np.bincount(groups, minlength=n_groups)
+    total = np.bincount(groups, weights=sizes, minlength=n_groups)
+
+    # sorted by group then size, so the median and max of each group are at fixed offsets from its start
+    order = np.lexsort((sizes, groups))
+    sorted_sizes = sizes[order]
+    starts = np.cumsum(count) - count
+    has = count > 0
+    median = np.full(n_groups, np.nan)
+    largest = np.full(n_groups, np.nan)
+    median[has] = (sorted_sizes[(starts + (count - 1) // 2)[has]] + sorted_sizes[(starts + count // 2)[has]]) / 2
+    largest[has] = sorted_sizes[(starts + count - 1)[has]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(has, total / np.maximum(count, 1), np.nan)
+
+    n_bins = len(size_bins) + 1
+    bins = np.searchsorted(size_bins, sizes, side='right')
+    binned = np.bincount(groups * n_bins + bins, minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+
+    stats = {'mean_lesion_volume': mean, 'median_lesion_volume': median, 'max_lesion_volume': largest}
+    stats.update({f'n_lesions_{name}': binned[:, k] for k, name in enumerate(_size_bin_names(size_bins))})
+    return count, stats
+
+def lesion_stats(wmh, brainroi, voxel_size, n_layers=N_LAYERS, threshold=0.5, fully_connected=False, size_bins=LESION_SIZE_BINS):
+    """
+    lesion statistics of a wmh segmentation (or probability map, binarised at threshold) within a bullseye parcellation.
+    voxel_size: volume of a voxel in mm^3
+    n_layers: number of layers the parcellation was made with
+    size_bins: lesion volume boundaries (mm^3) of the size distribution counts
+    returns (lesions, regions):
+        lesions: a dataframe with one row per lesion: its volume, the number of regions it overlaps, whether it spans
+            several regions, and the region holding most of its voxels (ties go to the higher region id) with the fraction
+            of the lesion in it. voxels outside the parcellation count towards no region.
+        regions: a dataframe with one row per bullseye region and a final 'total' row: the number of lesions overlapping it,
+            of those spanning several regions and of those assigned to it, the lesion volume in it, and the mean, median and max
+            volume and the size bin counts of the (whole) lesions assigned to it.
+    """
+    size_bins = np.sort(np.asarray(size_bins, dtype=np.float64))
+    roi_table = brain_roi_table(n_layers)
+    n_rois = max(roi_table) + 1
+
+    lesions, n_lesions = label_lesions(wmh, threshold, fully_connected)
+    pair_lesion, pair_roi, pair_voxels = lesion_region_overlap(lesions, brainroi, n_rois)
+    del lesions
+
+    lesion_voxels = np.bincount(pair_lesion, weights=pair_voxels, minlength=n_lesions + 1).astype(np.int64)
+    in_roi = pair_roi > 0
+    roi_lesion, roi_id, roi_voxels = pair_lesion[in_roi], pair_roi[in_roi], pair_voxels[in_roi]
+    n_regions = np.bincount(roi_lesion, minlength=n_lesions + 1)
+    spanning = n_regions > 1
+
+    # region with the most voxels of each lesion: the last pair of each lesion when sorted by lesion then overlap
+    order = np.lexsort((roi_id, roi_voxels, roi_lesion))
+    last = np.r_[roi_lesion[order][1:] != roi_lesion[order][:-1], True] if len(order) else np.zeros(0, dtype=bool)
+    dominant = np.zeros(n_lesions + 1, dtype=np.intp)
+    dominant_voxels = np.zeros(n_lesions + 1, dtype=np.int64)
+    dominant[roi_lesion[order][last]] = roi_id[order][last]
+    dominant_voxels[roi_lesion[order][last]] = roi_voxels[order][last]
+
+    ids = np.arange(1, n_lesions + 1)
+    sizes = lesion_voxels[1:] * voxel_size
+    region_names = np.array(['none'] + [roi_table.get(roi, 'none') for roi in range(1, n_rois)], dtype=object)
+    lesion_table = pd.DataFrame({
+        'lesion': ids,
+        'volume': sizes,
+        'n_regions': n_regions[1:],
+        'spanning': spanning[1:],
+        'region': region_names[dominant[1:]],
+        'region_fraction': dominant_voxels[1:] / np.maximum(lesion_voxels[1:], 1),
+    })
+
+    assigned = dominant[1:] > 0
+    n_assigned, size_stats = _grouped_size_stats(dominant[1:][assigned], sizes[assigned], n_rois, size_bins)
+    _, total_stats = _grouped_size_stats(np.zeros(n_lesions, dtype=np.intp), sizes, 1, size_bins)
+
+    rois = list(roi_table.keys())
+    region_table = pd.DataFrame({
+        'roi': rois + [0],
+        'region': [roi_table[roi] for roi in rois] + ['total'],
+        'n_lesions': np.r_[np.bincount(roi_id, minlength=n_rois)[rois], n_lesions],
+        'n_spanning': np.r_[np.bincount(roi_id[spanning[roi_lesion]], minlength=n_rois)[rois], np.count_nonzero(spanning)],
+        'n_lesions_assigned': np.r_[n_assigned[rois], np.count_nonzero(assigned)],
+        'lesion_volume': np.r_[np.bincount(roi_id, weights=roi_voxels, minlength=n_rois)[rois], lesion_voxels.sum()] * voxel_size,
+        **{name: np.r_[values[rois], total_stats[name]] for name, values in size_stats.items()},
+    })
+    return lesion_table, region_table
+
+def calc_lesion_stats(image, parc_file, wmh_seg, n_layers=N_LAYERS, threshold=0.5, fully_connected=False, size_bins=LESION_SIZE_BINS):
+    """lesion_stats from the files of a subject, the image is used for the voxel size"""
+    voxel_size = np.prod(read_header(image).GetSpacing())
+    return lesion_stats(load_image(wmh_seg), load_image(parc_file), voxel_size, n_layers, threshold, fully_connected, size_bins)
+
+def save_lesion_stats(image, parc_file, wmh_seg, n_layers=N_LAYERS, threshold=0.5, fully_connected=False, size_bins=LESION_SIZE_BINS, out_prefix=None):
+    """
+    saves the lesion and region tables of calc_lesion_stats as <out_prefix>_lesions.csv and <out_prefix>_lesion_regions.csv
+    (by default next to the parcellation). returns the paths of the two files.
+    """
+    lesion_table, region_table = calc_lesion_stats(image, parc_file, wmh_seg, n_layers, threshold, fully_connected, size_bins)
+    if out_prefix is None:
+        out_prefix = parc_file.split(".nii")[0]
+    lesions_file = out_prefix + "_lesions.csv"
+    regions_file = out_prefix + "_lesion_regions.csv"
+    lesion_table.to_csv(lesions_file, index=False)
+    region_table.to_csv(regions_file, index=False)
+    print(f"saved the statistics of {len(lesion_table)} lesions to: ", regions_file)
+    return [lesions_file, regions_file]
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical subject image the parcellation was computed for (used for the voxel size)")
+    parser.add_argument('-p', '--parc', required=True, type=str, help="path to the bullseye_parc image of the subject")
+    parser.add_argument('-w', '--wmh_seg', required=True, type=str, help="path to the WMH segmentation (or probability map) file")
+    parser.add_argument('--layers', default=N_LAYERS, type=int, help=f"number of concentric layers the parcellation was made with (default: {N_LAYERS})")
+    parser.add_argument('--threshold', default=0.5, type=float, help="voxels of the WMH map >= threshold are lesion voxels")
+    parser.add_argument('--fully_connected', action='store_true', help="also connect lesion voxels that only share an edge or corner")
+    parser.add_argument('--size_bins', default=list(LESION_SIZE_BINS), nargs='+', type=float, help="lesion volume boundaries (mm^3) of the size distribution")
+    parser.add_argument('-o', '--out_prefix', default=None, type=str, help="prefix of the output csv files (default: next to the parcellation)")
+
+    return parser
+
+def main(args):
+    save_lesion_stats(args.image, args.parc, args.wmh_seg, args.layers, args.threshold, args.fully_connected, args.size_bins, args.out_prefix)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
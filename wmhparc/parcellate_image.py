@@ -1,5 +1,6 @@
 import numpy as np
-from wmhparc.utils import save_manipulated_sitk_image_array, load_image
+from wmhparc.utils import load_image, read_image, read_header, image_from_array, output_ending, write_image, same_grid, resample_to_reference
+from wmhparc.concentric_layers import RING_BOUNDARIES
 import SimpleITK as sitk
 import pandas as pd
 
@@ -17,51 +18,21 @@ regions = {
     11 : "occipital-right",
 }
 
-rings = {
-    1:'layer1',
-    2:'layer2',
-    3:'layer3',
-    4:'layer4',
-}
+# number of concentric layers of the default layering
+N_LAYERS = len(RING_BOUNDARIES) + 1
 
-BRAIN_ROIS = {
-    1: 'frontal-left_layer1',
-    2: 'frontal-left_layer2',
-    3: 'frontal-left_layer3',
-    4: 'frontal-left_layer4',
-    5: 'parietal-left_layer1',
-    6: 'parietal-left_layer2',
-    7: 'parietal-left_layer3',
-    8: 'parietal-left_layer4',
-    9: 'temporal-left_layer1',
-    10: 'temporal-left_layer2',
-    11: 'temporal-left_layer3',
-    12: 'temporal-left_layer4',
-    13: 'occipital-left_layer1',
-    14: 'occipital-left_layer2',
-    15: 'occipital-left_layer3',
-    16: 'occipital-left_layer4',
-    17: 'bgit_layer1',
-    18: 'bgit_layer2',
-    19: 'bgit_layer3',
-    20: 'bgit_layer4',
-    21: 'frontal-right_layer1',
-    22: 'frontal-right_layer2',
-    23: 'frontal-right_layer3',
-    24: 'frontal-right_layer4',
-    25: 'parietal-right_layer1',
-    26: 'parietal-right_layer2',
-    27: 'parietal-right_layer3',
-    28: 'parietal-right_layer4',
-    29: 'temporal-right_layer1',
-    30: 'temporal-right_layer2',
-    31: 'temporal-right_layer3',
-    32: 'temporal-right_layer4',
-    33: 'occipital-right_layer1',
-    34: 'occipital-right_layer2',
-    35: 'occipital-right_layer3',
-    36: 'occipital-right_layer4'
-}
+def ring_table(n_layers=N_LAYERS):
+    """ring id -> name of each of n_layers concentric layers"""
+    return {ring: f'layer{ring}' for ring in range(1, n_layers + 1)}
+
+def brain_roi_table(n_layers=N_LAYERS):
+    """bullseye ROI id -> name for n_layers concentric layers, numbered by lobe (in the order of regions) and then by layer"""
+    names = [f'{region_name}_{ring_name}' for region_name in regions.values() for ring_name in ring_table(n_layers).values()]
+    return dict(enumerate(names, start=1))
+
+rings = ring_table()
+
+BRAIN_ROIS = brain_roi_table()
 
 synthseg_regions = {
     2:   'Left-Cerebral-White-Matter',
@@ -99,65 +70,243 @@ synthseg_regions = {
 }
 
 
-def create_combined_regions(atlas, pvrings):
-    img = np.zeros(atlas.shape)
+def _smallest_uint(max_value):
+    """the smallest of uint8 / uint16 that holds max_value"""
+    if max_value <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if max_value <= np.iinfo(np.uint16).max:
+        return np.uint16
+    raise ValueError(f"{max_value} does not fit in a uint16")
+
+def _code_dtype(n_layers):
+    """dtype of the (lobe, ring) lookup code lobe * (n_layers + 1) + ring, uint8 for up to 20 layers"""
+    return _smallest_uint((max(regions) + 1) * (n_layers + 1) - 1)
+
+def bullseye_lookup_table(n_layers=N_LAYERS):
+    """
+    lookup table from (lobe, ring) to the bullseye ROI id (see brain_roi_table), flattened so that
+    the entry for a voxel is at lobe * (n_layers + 1) + ring. unknown pairs map to 0.
+    the ROI ids are uint8, or uint16 for more layers than fit in a uint8 (more than 28).
+    """
+    stride = n_layers + 1
+    lut = np.zeros((max(regions) + 1) * stride, dtype=_smallest_uint(len(regions) * n_layers))
     counter = 1
     for region in regions.keys():
-        for ring in rings.keys():
-            img[(pvrings==ring) & (atlas==region)] = counter
+        for ring in range(1, n_layers + 1):
+            lut[region * stride + ring] = counter
             counter += 1
+    return lut
+
+def _lut_index(labels, size, dtype=np.uint8):
+    """
+    casts a label image to indices (of dtype) into a lookup table axis of the given size.
+    labels that are not whole numbers in [0, size) map to 0 (background).
+    """
+    labels = np.asarray(labels)
+    if labels.dtype == dtype and labels.max(initial=0) < size:
+        return labels.copy()
+    valid = (labels >= 0) & (labels < size)
+    if labels.dtype.kind == 'f':
+        valid &= (labels == np.floor(labels))
+    index = np.zeros(labels.shape, dtype=dtype)
+    index[valid] = labels[valid]
+    return index
+
+def bullseye_labels(norm_dist, brainmask, atlas, boundaries=RING_BOUNDARIES):
+    """
+    fused labelling kernel: takes the normalised ventricle-cortex distance, the brainmask
+    and the lobe atlas registered to the same grid and returns the bullseye ROI map as uint8
+    (1-36 for the default four layers, see brain_roi_table for other boundaries, uint16 for many layers).
+    the distance binning is accumulated straight into the (lobe, ring) lookup code, so the
+    only full volume intermediate is a single uint8 array (uint16 from 21 layers).
+    """
+    n_layers = len(boundaries) + 1
+    lut = bullseye_lookup_table(n_layers)
+    stride = n_layers + 1
+    code = _lut_index(atlas, max(regions) + 1, _code_dtype(n_layers))
+    code *= stride
+    code += 1
+    for boundary in boundaries:
+        code += norm_dist >= boundary
+    brain_rois = lut[code]
+    brain_rois *= brainmask & (norm_dist == norm_dist)
+    return brain_rois
 
-    return img
+def create_combined_regions(atlas, pvrings, n_layers=N_LAYERS):
+    lut = bullseye_lookup_table(n_layers)
+    dtype = _code_dtype(n_layers)
+    code = _lut_index(atlas, max(regions) + 1, dtype)
+    code *= n_layers + 1
+    code += _lut_index(pvrings, n_layers + 1, dtype)
+    return lut[code]
 
-def save_brain_parcellation_image(atlas_path, pvrings_path):
-    atlas_img = sitk.ReadImage(atlas_path)
-    atlas = sitk.GetArrayFromImage(atlas_img)
-    pvrings = load_image(pvrings_path)
+def brain_parcellation_image(atlas_img, pvrings_img, n_layers=N_LAYERS):
+    """in memory version of save_brain_parcellation_image, takes and returns sitk images"""
+    brain_rois = create_combined_regions(sitk.GetArrayFromImage(atlas_img), sitk.GetArrayFromImage(pvrings_img), n_layers)
+    return image_from_array(brain_rois, atlas_img)
 
-    out_path = pvrings_path.split("pvrings")[0]  + "bullseye_parc.nii.gz"
+def save_brain_parcellation_image(atlas_path, pvrings_path, compression_level=None, n_layers=N_LAYERS):
+    """
+    compression_level: gzip level of the output, 0 to write an uncompressed .nii file
+    n_layers: number of layers of the pvrings image. the parcellation keeps the layering suffix of the pvrings file name
+    """
+    atlas_img = read_image(atlas_path)
+    pvrings_img = read_image(pvrings_path)
 
-    brain_rois = create_combined_regions(atlas, pvrings)
+    prefix, layering = pvrings_path.rsplit("pvrings", 1)
+    out_path = prefix + "bullseye_parc" + layering.split(".nii")[0] + output_ending(compression_level)
 
-    save_manipulated_sitk_image_array(atlas_img, brain_rois, out_path)
+    write_image(brain_parcellation_image(atlas_img, pvrings_img, n_layers), out_path, kind='label', compression_level=compression_level)
 
     print("saved bullseye parcellation image to: ", out_path)
     return out_path
 
-def parcellate_from_brainroi(brainroi, label, voxel_size, prefix="wmh"):
-    results = {}
-    for region_id, region_name in BRAIN_ROIS.items():
-        results[f'{prefix}_{region_name}'] = np.sum(label[brainroi==region_id]) * voxel_size
-    return results
+def _label_index(labels):
+    """
+    flattens a label image into integer bin indices for np.bincount.
+    returns the indices and a boolean mask of the voxels to keep (None if all voxels are kept).
+    voxels that are negative or not whole numbers can never equal a region id, so they are dropped.
+    """
+    labels = np.asarray(labels).ravel()
+    index = labels.astype(np.intp)
+    invalid = index < 0
+    if labels.dtype.kind == 'f':
+        invalid |= (index != labels)
+    if invalid.any():
+        return index, ~invalid
+    return index, None
+
+def label_histogram(labels, weights=None):
+    """
+    single pass per-label statistics of a label image.
+    returns an array indexed by label value, holding the voxel count of each label
+    or, if weights is given, the sum of weights over the voxels of each label.
+    """
+    index, keep = _label_index(labels)
+    if weights is not None:
+        weights = np.asarray(weights).ravel()
+    if keep is not None:
+        index = index[keep]
+        weights = weights[keep] if weights is not None else None
+    return np.bincount(index, weights=weights)
+
+def joint_label_histogram(labels_a, labels_b, weights=None):
+    """
+    single pass joint histogram of two label images defined on the same grid.
+    returns a 2D array where entry [a, b] holds the voxel count (or sum of weights) of the voxels
+    with label a in labels_a and label b in labels_b.
+    """
+    index_a, keep_a = _label_index(labels_a)
+    index_b, keep_b = _label_index(labels_b)
+    n_a = index_a.max(initial=0) + 1
+    n_b = index_b.max(initial=0) + 1
+    combined = index_a * n_b + index_b
+    keep = keep_a if keep_b is None else (keep_b if keep_a is None else keep_a & keep_b)
+
+    if weights is not None:
+        weights = np.asarray(weights).ravel()
+    if keep is not None:
+        combined = combined[keep]
+        weights = weights[keep] if weights is not None else None
+    return np.bincount(combined, weights=weights, minlength=n_a * n_b).reshape(n_a, n_b)
+
+def _histogram_value(histogram, label):
+    return histogram[label] if 0 <= label < len(histogram) else 0
+
+def _volumes_from_histogram(histogram, region_names, voxel_size, prefix):
+    return {f'{prefix}_{region_name}': _histogram_value(histogram, region_id) * voxel_size for region_id, region_name in region_names.items()}
+
+def parcellate_from_brainroi(brainroi, label, voxel_size, prefix="wmh", n_layers=N_LAYERS):
+    return _volumes_from_histogram(label_histogram(brainroi, label), brain_roi_table(n_layers), voxel_size, prefix)
 
 def volumes_from_lobe_atlas(atlas, label, voxel_size, prefix='gray-m'):
-    results = {}
-    for region_id, region_name in regions.items():
-        results[f'{prefix}_{region_name}'] = np.sum(label[atlas==region_id]) * voxel_size
-    return results
+    return _volumes_from_histogram(label_histogram(atlas, label), regions, voxel_size, prefix)
 
 def volumes_from_synthseg(synthseg, voxel_size):
-    results = {}
-    for region_id, region_name in synthseg_regions.items():
-        results['synthseg_' + region_name] = np.sum(synthseg == region_id) * voxel_size
-    return results
+    return _volumes_from_histogram(label_histogram(synthseg), synthseg_regions, voxel_size, 'synthseg')
 
 def get_ICV(brainmask, voxel_size):
-    return {'icv': np.sum(brainmask != 0) * voxel_size}
+    return {'icv': np.count_nonzero(brainmask) * voxel_size}
+
 
+def parc_stats(brainroi, wmh, voxel_size, n_layers=N_LAYERS):
+    """in memory version of calc_parc_stats, takes the parcellation and wmh arrays and the voxel volume"""
+    results = parcellate_from_brainroi(brainroi, wmh, voxel_size, n_layers=n_layers)
+    results = {key:[value] for key, value in results.items()}
+    return pd.DataFrame(results)
 
-def calc_parc_stats(image, parc_file, wmh_seg):
+def calc_parc_stats(image, parc_file, wmh_seg, n_layers=N_LAYERS):
+    """n_layers: number of layers the parcellation was made with"""
     brainroi = load_image(parc_file)
     wmh = load_image(wmh_seg)
-    voxel_size = np.prod(sitk.ReadImage(image).GetSpacing())
+    voxel_size = np.prod(read_header(image).GetSpacing())
     
-    results = parcellate_from_brainroi(brainroi, wmh, voxel_size)
-    results = {key:[value] for key, value in results.items()}
-    return pd.DataFrame(results)
+    return parc_stats(brainroi, wmh, voxel_size, n_layers)
 
-    return results
 
+def parcellate_many(brainroi, wmh_maps, voxel_size, thresholds=None, prefix="wmh", n_layers=N_LAYERS):
+    """
+    per region volumes of several wmh maps (or one probabilistic map at several thresholds) from one parcellation.
+    the parcellation is indexed once, restricted to the voxels inside a region, and each map is reduced with a single bincount.
+
+    brainroi: the bullseye parcellation array
+    wmh_maps: dict of name -> wmh array on the same grid as brainroi
+    thresholds: if given, each map is binarised at every threshold (voxels >= threshold count as wmh),
+    otherwise the map values are summed as in parcellate_from_brainroi.
+    n_layers: number of layers the parcellation was made with
+    returns a dataframe with one row per (map, threshold), with the columns segmentation, threshold and the
+    columns of parcellate_from_brainroi.
+    """
+    roi_table = brain_roi_table(n_layers)
+    n_rois = max(roi_table) + 1
+    index, keep = _label_index(brainroi)
+    in_roi = (index > 0) & (index < n_rois)
+    if keep is not None:
+        in_roi &= keep
+    roi_voxels = np.flatnonzero(in_roi)
+    roi_index = index[roi_voxels]
+    del index, keep, in_roi
+
+    if thresholds is not None:
+        thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
 
-def get_all_brain_volumes(data):
+    rows = []
+    for name, wmh in wmh_maps.items():
+        values = np.asarray(wmh).ravel()[roi_voxels]
+        if thresholds is None:
+            histograms = {np.nan: np.bincount(roi_index, weights=values, minlength=n_rois)}
+        else:
+            # number of thresholds each voxel passes, so one joint (roi, bin) histogram covers every threshold
+            bins = np.searchsorted(thresholds, values, side='right')
+            # nan sorts above every threshold, but passes none of them (as with >=)
+            bins[np.isnan(values)] = 0
+            counts = np.bincount(roi_index * (len(thresholds) + 1) + bins, minlength=n_rois * (len(thresholds) + 1))
+            counts = counts.reshape(n_rois, len(thresholds) + 1)
+            at_least = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+            histograms = {threshold: at_least[:, k + 1] for k, threshold in enumerate(thresholds)}
+
+        for threshold, histogram in histograms.items():
+            rows.append({'segmentation': name, 'threshold': threshold, **_volumes_from_histogram(histogram, roi_table, voxel_size, prefix)})
+
+    return pd.DataFrame(rows)
+
+def calc_parc_stats_multi(image, parc_file, wmh_segs, thresholds=None, n_layers=N_LAYERS):
+    """
+    calc_parc_stats for several wmh segmentation files, or for one or more probabilistic maps at several thresholds.
+    the parcellation is loaded once. maps are named by their filename (or full path if filenames are not unique).
+    n_layers: number of layers the parcellation was made with
+    """
+    names = [wmh_seg.split("/")[-1].split(".nii")[0] for wmh_seg in wmh_segs]
+    if len(set(names)) != len(names):
+        names = list(wmh_segs)
+
+    brainroi = load_image(parc_file)
+    voxel_size = np.prod(read_header(image).GetSpacing())
+    wmh_maps = {name: load_image(wmh_seg) for name, wmh_seg in zip(names, wmh_segs)}
+
+    return parcellate_many(brainroi, wmh_maps, voxel_size, thresholds=thresholds, n_layers=n_layers)
+
+def get_all_brain_volumes(data, n_layers=N_LAYERS):
     """
     combines the: WMH parcellation,
     gray matter cortex volumes per lobe and hemisphere
@@ -166,25 +315,54 @@ def get_all_brain_volumes(data):
     synthseg_regions
 
     data: a dictionary that contains paths to the synthseg, brainroi, brainmask, brainatlas files and also voxel size
-    
+    n_layers: number of layers the brainroi parcellation was made with
     """
-    wmh_parc = parcellate_from_brainroi(data['brainroi'], data['wmh'], data['voxel_size'])
-    wmh_parc['wmh_total'] = np.sum(data['wmh']) * data['voxel_size']
-    gm = (data['synthseg'] == 3) | (data['synthseg'] == 42)
-    wm = (data['synthseg'] == 2) | (data['synthseg'] == 41)
-    gm_lobes = volumes_from_lobe_atlas(data['atlas'], gm, data['voxel_size'], prefix='gray-m-cerebral-cortex')
-    wm_lobes = volumes_from_lobe_atlas(data['atlas'], wm, data['voxel_size'], prefix='white-m_cerebral')
-    icv = get_ICV(data['brainmask'], data['voxel_size'])
-    synthseg_regions = volumes_from_synthseg(data['synthseg'], data['voxel_size'])
+    voxel_size = data['voxel_size']
+    wmh_parc = parcellate_from_brainroi(data['brainroi'], data['wmh'], voxel_size, n_layers=n_layers)
+    wmh_parc['wmh_total'] = np.sum(data['wmh']) * voxel_size
+
+    # one joint (lobe, synthseg label) histogram feeds the gm / wm lobe volumes and the synthseg volumes
+    atlas_synthseg = joint_label_histogram(data['atlas'], data['synthseg'])
+    atlas_synthseg = np.pad(atlas_synthseg, ((0, 0), (0, max(0, max(synthseg_regions) + 1 - atlas_synthseg.shape[1]))))
+    gm = atlas_synthseg[:, 3] + atlas_synthseg[:, 42]
+    wm = atlas_synthseg[:, 2] + atlas_synthseg[:, 41]
+    gm_lobes = _volumes_from_histogram(gm, regions, voxel_size, prefix='gray-m-cerebral-cortex')
+    wm_lobes = _volumes_from_histogram(wm, regions, voxel_size, prefix='white-m_cerebral')
+    icv = get_ICV(data['brainmask'], voxel_size)
+    synthseg_vols = _volumes_from_histogram(atlas_synthseg.sum(axis=0), synthseg_regions, voxel_size, 'synthseg')
     
-    combined = (wmh_parc | gm_lobes | wm_lobes | icv | synthseg_regions)
+    combined = (wmh_parc | gm_lobes | wm_lobes | icv | synthseg_vols)
     return combined
     # return wmh_parc, gm_lobes, wm_lobes, icv, synthseg_regions 
 
-def parcellate_wmh(atlas, pvrings, wmh, voxel_size):
+def calc_all_brain_volumes(image, parc_file, wmh_seg, atlas_file, synthseg, brainmask, n_layers=N_LAYERS):
+    """
+    get_all_brain_volumes from the files of a subject, as a one row dataframe.
+    the synthseg image is resampled to the grid of the image if it is not already on it.
+    """
+    header = read_header(image)
+    synthseg_img = read_image(synthseg)
+    if not same_grid(synthseg_img, header):
+        synthseg_img = resample_to_reference(synthseg_img, header, use_nearest_neighbor=True)
+
+    data = {
+        'brainroi': load_image(parc_file),
+        'wmh': load_image(wmh_seg),
+        'atlas': load_image(atlas_file),
+        'synthseg': sitk.GetArrayViewFromImage(synthseg_img),
+        'brainmask': load_image(brainmask),
+        'voxel_size': np.prod(header.GetSpacing()),
+    }
+    volumes = get_all_brain_volumes(data, n_layers)
+    return pd.DataFrame({key: [value] for key, value in volumes.items()})
+
+def parcellate_wmh(atlas, pvrings, wmh, voxel_size, n_layers=N_LAYERS):
+    ring_region = joint_label_histogram(pvrings, atlas, wmh)
+    ring_names = ring_table(n_layers)
     results = {}
-    for ring in rings.keys():
+    for ring in ring_names.keys():
         for region in regions.keys():
-            results[f'{regions[region]}_{rings[ring]}'] = np.sum(wmh[(pvrings==ring) & (atlas==region)]) * voxel_size
+            in_range = ring < ring_region.shape[0] and region < ring_region.shape[1]
+            results[f'{regions[region]}_{ring_names[ring]}'] = (ring_region[ring, region] if in_range else 0) * voxel_size
 
     return results
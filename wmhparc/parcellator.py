@@ -0,0 +1,55 @@
+"""
+Long lived parcellation pipeline with the template and atlas kept in memory.
+
+The template (and its brainmask) is read, cropped and normalised for registration once, and the lobe atlas (and any
+other label maps to warp with it) read once, when the Parcellator is created. Each subject is then run in memory (see run_subject_in_memory), so per subject only
+the subject images are read. Used by the parcellation daemon (run_daemon.py), or directly from python:
+
+    parcellator = Parcellator(template, atlas, template_brainmask)
+    df = parcellator.run(image, brainmask, synthseg, wmh_seg, output_folder)
+"""
+from wmhparc.registration import prepare_registration_image, read_ants, set_itk_threads, REGISTRATION_PROFILES
+from wmhparc.run_parcellation import run_subject_in_memory
+from wmhparc.concentric_layers import RING_BOUNDARIES
+from wmhparc.utils import read_image
+
+class Parcellator:
+    """
+    template, atlas, template_brainmask: paths of the template image, the brainlobe atlas and the template brainmask (ICV)
+    profile, threads, random_seed, crop_margin: registration options, see run_ants_SyNAggro
+    use_cache, native_spacing, lean_distances, compression_level, save_distance_maps, boundaries: see run_subject_in_memory
+    label_maps: optional dict of name -> path of other label maps in template space to warp along with the atlas
+    """
+    def __init__(self, template, atlas, template_brainmask=None, profile='default', threads=None, random_seed=None, crop_margin=None,
+                 use_cache=True, native_spacing=True, lean_distances=False, compression_level=None, save_distance_maps=True,
+                 boundaries=RING_BOUNDARIES, label_maps=None):
+        if profile not in REGISTRATION_PROFILES:
+            raise ValueError(f"unknown registration profile {profile}, must be one of {list(REGISTRATION_PROFILES.keys())}")
+        if threads is not None:
+            set_itk_threads(threads)
+
+        self.template = template
+        self.atlas = atlas
+        self.template_brainmask = template_brainmask
+        self.registration_options = dict(profile=profile, threads=threads, random_seed=random_seed, crop_margin=crop_margin)
+        self.options = dict(
+            use_cache=use_cache, native_spacing=native_spacing, lean_distances=lean_distances,
+            compression_level=compression_level, save_distance_maps=save_distance_maps, boundaries=tuple(boundaries),
+        )
+
+        print("loading template and atlas")
+        self.template_images = prepare_registration_image(template, template_brainmask, crop_margin)
+        self.atlas_image = read_ants(atlas)
+        self.label_maps = {name: read_image(path) for name, path in label_maps.items()} if label_maps else None
+
+    def run(self, image, brainmask, synthseg, wmh_seg, output_folder, save_intermediates=False, report=None):
+        """
+        parcellates one subject, returns the WMH bullseye volumes as a one row dataframe.
+        save_intermediates, report: see run_subject_in_memory
+        """
+        return run_subject_in_memory(
+            image, brainmask, synthseg, wmh_seg, self.template, self.atlas, output_folder,
+            template_brainmask=self.template_brainmask, save_intermediates=save_intermediates, report=report,
+            template_images=self.template_images, atlas_image=self.atlas_image, label_maps=self.label_maps,
+            **self.options, **self.registration_options,
+        )
@@ -1,33 +1,74 @@
 import ants
+import SimpleITK as sitk
+import numpy as np
 import os
-import subprocess
+from wmhparc.registration_profiles import REGISTRATION_PROFILES, set_itk_threads, ants_started
 
 ###################################################################################################################
 # ANTS registration tools
 ###################################################################################################################
-def run_ants_SyNAggro(fixed, moving, out, outsuffix, label=False, mask=None, moving_mask=None):
+
+def crop_to_mask(image, mask, margin):
+    """
+    crops an ANTsImage to the bounding box of the nonzero voxels of an ANTsImage mask on the same grid,
+    padded by margin voxels. the result can be placed back in the full grid with ants.decrop_image.
+    """
+    present = np.nonzero(mask.numpy())
+    if len(present[0]) == 0:
+        return image
+    lower = [max(int(p.min()) - margin, 0) for p in present]
+    upper = [min(int(p.max()) + margin + 1, size) for p, size in zip(present, image.shape)]
+    return ants.crop_indices(image, lower, upper)
+
+def read_ants(image):
+    """reads an ANTsImage from a filepath, ANTsImages are returned as they are"""
+    return ants.image_read(image) if isinstance(image, str) else image
+
+def prepare_registration_image(image, mask=None, crop_margin=None, label=False):
+    """
+    reads (if filepaths are given), crops and normalises an image and its mask the way run_ants_SyNAggro does
+    for the fixed and moving images. returns the (image, mask) ANTsImages.
+    the template can be prepared once and reused across registrations with run_ants_SyNAggro(..., moving_prepared=True).
+    """
+    ants_started()
+    image = read_ants(image)
+    mask = read_ants(mask) if mask is not None else None
+    if crop_margin is not None and mask is not None:
+        image, mask = crop_to_mask(image, mask, crop_margin), crop_to_mask(mask, mask, crop_margin)
+    if not label:
+        image = ants.iMath(image, 'Normalize')
+    return image, mask
+
+def run_ants_SyNAggro(fixed, moving, out, outsuffix, label=False, mask=None, moving_mask=None, profile='default', threads=None, random_seed=None, crop_margin=None, moving_prepared=False):
     """
     runs the ANTS affine orientation
     fixed, moving, out are the filepaths of the fixed, moving, and desired output location respectively.
     orient: whether to orient the images to standard orientation or not.
     out: the out path to save the registration transform, and optionally the registered image.
+    profile: name of the registration configuration in REGISTRATION_PROFILES
+    threads: number of ITK threads to use (default: ITK's default)
+    random_seed: seed for the metric sampling, for reproducible runs (results are only bit identical with threads=1)
+    crop_margin: if given, the fixed and moving images are cropped to the bounding box of mask and moving_mask respectively,
+    padded by crop_margin voxels, before registration. the affine is in physical space, but the SyN warp field only
+    covers the cropped fixed grid: outside the bounding box of mask (plus crop_margin) only the affine applies, so images
+    should be warped with the same crop (crop_mask and crop_margin of apply_ants_transforms) to the box the warp is defined on.
+    moving_prepared: if True, moving and moving_mask are ANTsImages already prepared with prepare_registration_image
+    (with the same crop_margin and label), and are used as they are.
     """
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError(f"unknown registration profile {profile}, must be one of {list(REGISTRATION_PROFILES.keys())}")
+    if threads is not None:
+        set_itk_threads(threads)
+    ants_started()
     
-    print(f"ANTS registering {moving} to {fixed}")
-    fixed = ants.image_read(fixed)
-    moving = ants.image_read(moving)
-
-    if not label:
-        fixed = ants.iMath(fixed, 'Normalize')
-        moving = ants.iMath(moving, 'Normalize')
-        
-        # fixed[fixed==0] = 1e-6
-        # moving[moving==0] = 1e-6)
+    print(f"ANTS registering {moving if isinstance(moving, str) else 'preloaded image'} to {fixed} ({profile} profile)")
+    fixed, mask = prepare_registration_image(fixed, mask, crop_margin, label)
+    if not moving_prepared:
+        moving, moving_mask = prepare_registration_image(moving, moving_mask, crop_margin, label)
     
     result = ants.registration(
         fixed,
         moving,
-        type_of_transform='SyNAggro', #, 'SyNRA',#'SyNRA', #'Affine', #SyNRA #SyNAggro 
         # initial_transform=initial_transform,
         outprefix=out.split(".nii")[0] + "_" + outsuffix + "_",
         grad_step=0.2,
@@ -35,31 +76,31 @@ def run_ants_SyNAggro(fixed, moving, out, outsuffix, label=False, mask=None, mov
         total_sigma=0,
         aff_metric='mattes',
         aff_sampling=64,
-        aff_random_sampling_rate=0.3,
         syn_metric='mattes',
         syn_sampling=64,
-        reg_iterations=(80, 40, 10),
-        aff_iterations=(2100, 1200, 1200, 10),
-        aff_shrink_factors=(6, 4, 2, 1),
-        aff_smoothing_sigmas=(3, 2, 1, 0),
         write_composite_transform=False,
-        random_seed=None,
+        random_seed=random_seed,
         verbose=False,
         multivariate_extras=None,
         restrict_transformation=None,
         smoothing_in_mm=False,
-        mask=ants.image_read(mask) if mask is not None else None,
-        moving_mask=ants.image_read(moving_mask) if moving_mask is not None else None,
+        mask=mask,
+        moving_mask=moving_mask,
+        **REGISTRATION_PROFILES[profile],
     )
 
 
-def run_ants(fixed, moving, out, save=True, normalize=False, rigid=False):
+def run_ants(fixed, moving, out, save=True, normalize=False, rigid=False, threads=None, random_seed=None):
     """
     runs the ANTS affine orientation
     fixed, moving, out are the filepaths of the fixed, moving, and desired output location respectively.
     orient: whether to orient the images to standard orientation or not.
     out: the out path to save the registration transform, and optionally the registered image.
+    threads, random_seed: see run_ants_SyNAggro
     """
+    if threads is not None:
+        set_itk_threads(threads)
+    ants_started()
     
     print(f"ANTS registering {moving} to {fixed}")
     fixed = ants.image_read(fixed)
@@ -87,7 +128,7 @@ def run_ants(fixed, moving, out, save=True, normalize=False, rigid=False):
         aff_shrink_factors=(6, 4, 2, 1),
         aff_smoothing_sigmas=(3, 2, 1, 0),
         write_composite_transform=False,
-        random_seed=None,
+        random_seed=random_seed,
         verbose=False,
         multivariate_extras=None,
         restrict_transformation=None,
@@ -98,12 +139,12 @@ def run_ants(fixed, moving, out, save=True, normalize=False, rigid=False):
         ants.image_write(result['warpedmovout'], out)
     
     
-def apply_ants_transforms(fixed, moving, out, transforms_list, is_label=False, write=True, whichtoinvert=None, multiimage=False):
+def apply_ants_transforms(fixed, moving, out, transforms_list, is_label=False, write=True, whichtoinvert=None, multiimage=False, crop_mask=None, crop_margin=None):
     """
-    fixed : path to a ANTsImage
+    fixed : path to a ANTsImage (or an ANTsImage)
         fixed image defining domain into which the moving image is transformed.
 
-    moving : path to a AntsImage
+    moving : path to a AntsImage (or an ANTsImage, e.g a preloaded atlas)
         moving image to be mapped to fixed space.
     
     out : path where the transformed image will be saved
@@ -115,6 +156,9 @@ def apply_ants_transforms(fixed, moving, out, transforms_list, is_label=False, w
     whichtoinvert: a list of booleans, stating whether each transform should be inverted or not. only works for matrix transforms. for nonlinear, need to pass the invWarp transform to transforms_list. 
     
     multiimage: set to True if transforming a 4D image.
+
+    crop_mask, crop_margin: path to a mask in the fixed space. if given, the moving image is only resampled within the bounding box of
+    the mask padded by crop_margin voxels, and is zero elsewhere in the fixed image grid.
     """
     if not isinstance(transforms_list, list):
         raise ValueError(f"transforms_list must be a list")
@@ -122,8 +166,13 @@ def apply_ants_transforms(fixed, moving, out, transforms_list, is_label=False, w
     if len(transforms_list) == 0:
         raise ValueError("no transforms to apply")
         
-    fixed  = ants.image_read(fixed)
-    moving = ants.image_read(moving)
+    ants_started()
+    fixed  = read_ants(fixed)
+    moving = read_ants(moving)
+
+    full_fixed = fixed
+    if crop_mask is not None:
+        fixed = crop_to_mask(fixed, read_ants(crop_mask), crop_margin or 0)
     
     transformed_image = ants.apply_transforms(
         fixed=fixed,
@@ -133,9 +182,89 @@ def apply_ants_transforms(fixed, moving, out, transforms_list, is_label=False, w
         interpolator=("genericLabel" if is_label else "linear"),
         whichtoinvert=whichtoinvert[::-1] if whichtoinvert is not None else None,
     )
+
+    if crop_mask is not None:
+        # place the result back into the full fixed image grid
+        transformed_image = ants.decrop_image(transformed_image, full_fixed * 0)
     
     if write:
         ants.image_write(transformed_image, out)
     else:
         return transformed_image
 
+def compose_transforms(fixed, transforms_list, out_prefix, crop_mask=None, crop_margin=None):
+    """
+    composes a list of transforms (in the order of application, see apply_ants_transforms) into a single dense
+    displacement field on the grid of the fixed image, so the transform chain is evaluated once for any number of
+    images warped with apply_displacement_field. the field is saved as <out_prefix>comptx.nii.gz, returns its path.
+    crop_mask, crop_margin: as for apply_ants_transforms, the field only covers the bounding box of the mask padded by crop_margin voxels.
+    with transforms from a cropped registration, use the crop of the registration: the SyN warp is only defined inside it.
+    """
+    if not isinstance(transforms_list, list) or len(transforms_list) == 0:
+        raise ValueError("transforms_list must be a non empty list")
+
+    ants_started()
+    fixed = read_ants(fixed)
+    if crop_mask is not None:
+        fixed = crop_to_mask(fixed, read_ants(crop_mask), crop_margin or 0)
+
+    # with compose, the transforms are written out as one displacement field instead of being applied
+    field = ants.apply_transforms(fixed=fixed, moving=fixed, transformlist=transforms_list[::-1], compose=out_prefix)
+    if field is None or not os.path.exists(field):
+        raise RuntimeError(f"composing the transforms {transforms_list} failed")
+    return field
+
+def apply_displacement_field(fixed, moving_images, field, is_label=True):
+    """
+    warps several images to the fixed image with a displacement field from compose_transforms, which is read once.
+    fixed: sitk image (or header, see read_header) defining the output grid, i.e the full fixed image grid
+    moving_images: dict of name -> sitk image (or path) in the moving space, e.g the lobe atlas and other label maps
+    field: path of the displacement field. if it only covers part of the fixed grid (see crop_mask in compose_transforms),
+    the warped images are zero outside it.
+    is_label: interpolate as label images (per label linear interpolation, as the ants genericLabel interpolator) or linearly
+    returns a dict of name -> warped sitk image
+    """
+    field_img = sitk.ReadImage(field, sitk.sitkVectorFloat64)
+    size, origin, spacing, direction = field_img.GetSize(), field_img.GetOrigin(), field_img.GetSpacing(), field_img.GetDirection()
+    # index of the field origin in the fixed grid (computed directly, as a header has no TransformPhysicalPointToIndex)
+    fixed_axes = np.array(fixed.GetDirection()).reshape(3, 3) * np.array(fixed.GetSpacing())
+    offset = [int(round(i)) for i in np.linalg.solve(fixed_axes, np.array(origin) - np.array(fixed.GetOrigin()))]
+    cropped = tuple(size) != tuple(fixed.GetSize()) or any(offset)
+
+    # takes ownership of the field image
+    transform = sitk.DisplacementFieldTransform(field_img)
+    interpolator = sitk.sitkLabelLinear if is_label else sitk.sitkLinear
+
+    warped = {}
+    for name, moving in moving_images.items():
+        moving = sitk.ReadImage(moving) if isinstance(moving, str) else moving
+        image = sitk.Resample(moving, size, transform, interpolator, origin, spacing, direction, 0.0, moving.GetPixelID())
+        if cropped:
+            full = sitk.Image([int(s) for s in fixed.GetSize()], moving.GetPixelID())
+            full.SetSpacing(fixed.GetSpacing())
+            full.SetOrigin(fixed.GetOrigin())
+            full.SetDirection(fixed.GetDirection())
+            image = sitk.Paste(full, image, image.GetSize(), [0, 0, 0], offset)
+        warped[name] = image
+    return warped
+
+
+def ants_to_sitk(ants_image, reference=None):
+    """
+    converts an ANTsImage to a sitk image, taking the metadata from a sitk reference image (or header) on the same
+    grid (e.g the fixed image the ANTsImage was resampled to), or from the ANTsImage itself if no reference is given.
+    """
+    # ANTsImage arrays are indexed (x, y, z), sitk arrays (z, y, x)
+    sitk_image = sitk.GetImageFromArray(ants_image.numpy().T)
+    if reference is not None:
+        if tuple(reference.GetSize()) != sitk_image.GetSize():
+            raise ValueError(f"reference size {reference.GetSize()} does not match the ANTsImage size {sitk_image.GetSize()}")
+        sitk_image.SetSpacing(reference.GetSpacing())
+        sitk_image.SetOrigin(reference.GetOrigin())
+        sitk_image.SetDirection(reference.GetDirection())
+    else:
+        # both are ITK images, so share the same physical space conventions
+        sitk_image.SetSpacing([float(s) for s in ants_image.spacing])
+        sitk_image.SetOrigin([float(o) for o in ants_image.origin])
+        sitk_image.SetDirection([float(d) for d in np.asarray(ants_image.direction).flatten()])
+    return sitk_image
@@ -0,0 +1,59 @@
+"""
+Registration speed / accuracy profiles and the ITK thread budget, in their own module so the command line interfaces
+can use them without (or before) importing ants.
+"""
+import os
+import warnings
+
+ITK_THREADS_VARIABLE = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+# named registration configurations for run_ants_SyNAggro, trading accuracy for runtime.
+# 'default' is the configuration the atlas was validated with.
+REGISTRATION_PROFILES = {
+    'fast': dict(
+        type_of_transform='SyN',
+        reg_iterations=(40, 20, 0),
+        aff_iterations=(1000, 500, 250),
+        aff_shrink_factors=(4, 2, 1),
+        aff_smoothing_sigmas=(2, 1, 0),
+        aff_random_sampling_rate=0.2,
+    ),
+    'default': dict(
+        type_of_transform='SyNAggro',
+        reg_iterations=(80, 40, 10),
+        aff_iterations=(2100, 1200, 1200, 10),
+        aff_shrink_factors=(6, 4, 2, 1),
+        aff_smoothing_sigmas=(3, 2, 1, 0),
+        aff_random_sampling_rate=0.3,
+    ),
+    'accurate': dict(
+        type_of_transform='SyNAggro',
+        reg_iterations=(100, 70, 50, 20),
+        aff_iterations=(2100, 1200, 1200, 100),
+        aff_shrink_factors=(6, 4, 2, 1),
+        aff_smoothing_sigmas=(3, 2, 1, 0),
+        aff_random_sampling_rate=0.5,
+    ),
+}
+
+# number of ITK threads ANTs started with in this process (None before it ran), see set_itk_threads
+_ants_threads = None
+
+def set_itk_threads(threads):
+    """
+    sets the number of threads used by ITK (and so ANTs) in this process.
+    ITK reads the environment variable when it creates its global thread pool, so this should be called before ants is
+    imported (the command lines do so before importing the pipeline). a warning is given if ANTs already ran with
+    another number of threads, which it then keeps using.
+    """
+    if _ants_threads is not None and _ants_threads != str(threads):
+        warnings.warn(f"ANTs already ran with {_ants_threads} ITK threads in this process, so may ignore the new number of threads ({threads})")
+    os.environ[ITK_THREADS_VARIABLE] = str(threads)
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def ants_started():
+    """records the number of ITK threads ANTs runs with, called by the registration functions before each ants call"""
+    global _ants_threads
+    if _ants_threads is None:
+        _ants_threads = os.environ.get(ITK_THREADS_VARIABLE, "default")
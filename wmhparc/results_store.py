@@ -0,0 +1,186 @@
+"""
+Cohort results store: the volumes of every subject (and run) of a cohort in one columnar Parquet dataset.
+
+A row is keyed by (subject, run), where run names the configuration the subject was processed with (e.g the
+layering), so the same subject can be stored for several runs. Rows are written by upsert:
+
+    store = ResultsStore(path)
+    store.upsert(df, subject, run)
+
+each upsert writes the row to its own part file in <path>/parts, named after its key and moved into place atomically,
+so workers can upsert concurrently without locking, and upserting a (subject, run) again replaces its row.
+compact() merges the part files into the single <path>/results.parquet file (run_batch does this at the end, and
+run_parcellation once COMPACT_THRESHOLD parts have piled up, see compact_if_needed), and read() returns the latest row
+of each key, reading only the requested columns. Rows of different runs can have different columns (e.g the regions of
+another layering), missing columns read as nan.
+
+Requires pyarrow (or fastparquet) for pandas to read and write Parquet files.
+"""
+import os
+import glob
+import fcntl
+import hashlib
+import time
+import argparse
+import pandas as pd
+
+KEY_COLUMNS = ['subject', 'run']
+UPDATED_COLUMN = 'updated_at'
+RESULTS_FILENAME = "results.parquet"
+PARTS_FOLDER = "parts"
+# number of part files from which compact_if_needed merges them
+COMPACT_THRESHOLD = 100
+
+class ResultsStore:
+    """
+    path: folder of the store, created if it does not exist
+    """
+    def __init__(self, path):
+        self.path = path
+        self.results_path = os.path.join(path, RESULTS_FILENAME)
+        self.parts_path = os.path.join(path, PARTS_FOLDER)
+        os.makedirs(self.parts_path, exist_ok=True)
+
+    def _part_path(self, subject, run):
+        digest = hashlib.sha256(f"{subject}\0{run}".encode()).hexdigest()[:32]
+        return os.path.join(self.parts_path, digest + ".parquet")
+
+    def upsert(self, df, subject, run="default"):
+        """
+        stores the one row dataframe df (e.g from run_subject) as the row of (subject, run), replacing any earlier row.
+        returns the path of the part file written.
+        """
+        if len(df) != 1:
+            raise ValueError(f"can only upsert one row per subject and run, not {len(df)}")
+        row = df.drop(columns=[column for column in KEY_COLUMNS + [UPDATED_COLUMN] if column in df.columns]).reset_index(drop=True)
+        row.insert(0, 'subject', str(subject))
+        row.insert(1, 'run', str(run))
+        row[UPDATED_COLUMN] = time.time_ns()
+
+        part_path = self._part_path(subject, run)
+        tmp_path = f"{part_path}.{os.getpid()}.tmp"
+        try:
+            row.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, part_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return part_path
+
+    def _part_files(self):
+        return sorted(glob.glob(os.path.join(self.parts_path, "*.parquet")))
+
+    def _read_files(self, files, columns=None):
+        """reads the files, only the columns of each file's schema that are requested (the others are filled with nan)"""
+        import pyarrow.parquet as pq
+        if columns is not None:
+            columns = list(dict.fromkeys(KEY_COLUMNS + list(columns) + [UPDATED_COLUMN]))
+        frames = []
+        for filepath in files:
+            try:
+                if columns is None:
+                    frames.append(pd.read_parquet(filepath))
+                    continue
+                schema = set(pq.read_schema(filepath).names)
+                frame = pd.read_parquet(filepath, columns=[column for column in columns if column in schema])
+            except FileNotFoundError:
+                # removed by a concurrent compaction, its row is then in the results file
+                continue
+            frames.append(frame.reindex(columns=columns))
+        return frames
+
+    @staticmethod
+    def _latest(frames):
+        """concatenates the frames, keeping the most recently updated row of each (subject, run)"""
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame(columns=KEY_COLUMNS + [UPDATED_COLUMN])
+        df = pd.concat(frames, ignore_index=True)
+        df = df.sort_values(UPDATED_COLUMN, kind='stable').drop_duplicates(KEY_COLUMNS, keep='last')
+        return df.sort_values(KEY_COLUMNS).reset_index(drop=True)
+
+    def read(self, columns=None, subjects=None, runs=None):
+        """
+        returns the latest row of each (subject, run) as a dataframe.
+        columns: only read these columns (plus subject, run and updated_at), e.g ['icv', 'wmh_total']
+        subjects, runs: only return the rows of these subjects / runs
+        """
+        # the parts are listed first, so a compaction running meanwhile moves their rows into the results file read after
+        part_files = self._part_files()
+        frames = self._read_files(part_files, columns)
+        if os.path.exists(self.results_path):
+            frames += self._read_files([self.results_path], columns)
+        df = self._latest(frames)
+        if subjects is not None:
+            df = df[df['subject'].isin([str(subject) for subject in subjects])]
+        if runs is not None:
+            df = df[df['run'].isin([str(run) for run in runs])]
+        return df.reset_index(drop=True)
+
+    def compact(self):
+        """
+        merges the part files into the results file and removes them. returns the number of part files merged.
+        parts upserted while compacting are kept and merged by the next compaction.
+        """
+        with open(os.path.join(self.path, ".compact.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            part_files = self._part_files()
+            if not part_files:
+                return 0
+            # a part replaced while it is being merged has a new modification time, and is not removed
+            part_mtimes = {}
+            for filepath in part_files:
+                try:
+                    part_mtimes[filepath] = os.stat(filepath).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+            frames = self._read_files(part_files)
+            if os.path.exists(self.results_path):
+                frames += self._read_files([self.results_path])
+
+            tmp_path = self.results_path + ".tmp"
+            self._latest(frames).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.results_path)
+
+            for filepath, mtime in part_mtimes.items():
+                try:
+                    if os.stat(filepath).st_mtime_ns == mtime:
+                        os.remove(filepath)
+                except FileNotFoundError:
+                    continue
+        print(f"compacted {len(part_mtimes)} results into: ", self.results_path)
+        return len(part_mtimes)
+
+    def compact_if_needed(self, threshold=COMPACT_THRESHOLD):
+        """compacts the store once at least threshold part files have piled up, returns the number of part files merged"""
+        if len(self._part_files()) < threshold:
+            return 0
+        return self.compact()
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--store', required=True, type=str, help="path to the results store folder")
+    parser.add_argument('--compact', action='store_true', help="merge the upserted part files into the results file")
+    parser.add_argument('-c', '--columns', default=None, nargs='+', type=str, help="only export these columns (plus subject, run and updated_at)")
+    parser.add_argument('--subjects', default=None, nargs='+', type=str, help="only export these subjects")
+    parser.add_argument('--runs', default=None, nargs='+', type=str, help="only export these runs")
+    parser.add_argument('-o', '--output', default=None, type=str, help="export the rows to this csv (or .parquet) file")
+
+    return parser
+
+def main(args):
+    store = ResultsStore(args.store)
+    if args.compact:
+        store.compact()
+    if args.output is not None:
+        df = store.read(columns=args.columns, subjects=args.subjects, runs=args.runs)
+        if args.output.endswith(".parquet"):
+            df.to_parquet(args.output, index=False)
+        else:
+            df.to_csv(args.output, index=False)
+        print(f"exported {len(df)} rows to: ", args.output)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
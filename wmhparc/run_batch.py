@@ -0,0 +1,204 @@
+"""
+Run the bullseye parcellation for a cohort of subjects listed in a manifest csv.
+
+Subjects are distributed over a pool of worker processes, each running the single subject pipeline
+with a fixed number of ITK threads. Each worker reads the template and atlas once and reuses them for all
+of its subjects. The per subject WMH volumes are aggregated into one results table, and optionally upserted
+by each worker into a cohort results store (see results_store.py).
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from wmhparc.registration_profiles import REGISTRATION_PROFILES
+
+MANIFEST_COLUMNS = ['image', 'brainmask', 'synthseg', 'wmh_seg']
+
+# registration is the only multi-threaded stage and scales poorly beyond a handful of threads,
+# so by default the cpu budget is spent on running more subjects at once instead.
+DEFAULT_THREADS_PER_JOB = 4
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--manifest', required=True, type=str, help="path to the manifest csv, with columns image, brainmask, synthseg, wmh_seg and optionally subject")
+    parser.add_argument('-t', '--template', required=True, type=str, help="path to the 73yr T1w template image")
+    parser.add_argument('-a', '--atlas', required=True, type=str, help="path to the brainlobe atlas")
+    parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
+    parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder, results for each subject are saved to a subfolder named after the subject")
+    parser.add_argument('-c', '--cpus', default=None, type=int, help="total number of cpus to use (default: all available)")
+    parser.add_argument('-j', '--workers', default=None, type=int, help="number of subjects processed at once (default: derived from the cpu budget)")
+    parser.add_argument('--threads_per_job', default=None, type=int, help="number of ITK threads per subject (default: derived from the cpu budget)")
+    parser.add_argument('-p', '--registration_profile', default='default', choices=list(REGISTRATION_PROFILES.keys()), help="registration speed / accuracy profile")
+    parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration, for reproducible runs")
+    parser.add_argument('--crop_margin', default=None, type=int, help="crop to the brainmask bounding box padded by this many voxels for registration and atlas warping")
+    parser.add_argument('--compression_level', default=None, type=int, choices=range(10), help="gzip level (1-9) of the output images, 0 to write uncompressed .nii files")
+    parser.add_argument('--resample_1mm_distances', action='store_true', help="compute the distance maps on a 1x1x1 reslice of the synthseg image and resample them back, instead of at the native voxel spacing of the image")
+    parser.add_argument('--lean_distances', action='store_true', help="compute the distance maps cropped to the brain, concurrently and as float32 to reduce the peak memory of each worker")
+    parser.add_argument('--no_distance_maps', action='store_true', help="do not save the ventricle and cortex distance maps")
+    parser.add_argument('--layers', default=None, type=int, help="number of equidistant concentric layers (default: 4)")
+    parser.add_argument('--layer_boundaries', default=None, nargs='+', type=float, help="instead of --layers, the normalised distance boundaries between the layers")
+    parser.add_argument('--label_maps', default=None, nargs='+', type=str, help="other label maps in template space to warp along with the atlas in one pass, as name=path (saved as <image>_<name>)")
+    parser.add_argument('--report', action='store_true', help="save a json report of the resources used by each stage to each subject folder")
+    parser.add_argument('--no_cache', action='store_true', help="rerun every stage even if its inputs are unchanged since the last run")
+    parser.add_argument('--in_memory', action='store_true', help="pass images between the stages in memory instead of through intermediate files")
+    parser.add_argument('--brain_volumes', action='store_true', help="also calculate the gray and white matter lobe volumes, ICV and SynthSeg volumes of each subject")
+    parser.add_argument('--lesion_stats', action='store_true', help="also calculate lesion level statistics per bullseye region for each subject")
+    parser.add_argument('--store', default=None, type=str, help="upsert the volumes of each subject (with the brain volumes) to the cohort results store in this folder")
+    parser.add_argument('--run_name', default="default", type=str, help="name of the run the volumes are stored under in the results store")
+    parser.add_argument('-r', '--results', default=None, type=str, help="path of the aggregated results csv (default: <output_folder>/cohort_wmh_vols.csv)")
+
+    return parser
+
+def split_cpu_budget(cpus=None, workers=None, threads_per_job=None):
+    """
+    splits a cpu budget between the number of subjects run at once and the ITK threads per subject.
+    any of workers and threads_per_job that is not given is derived from the budget.
+    returns (workers, threads_per_job)
+    """
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    cpus = max(1, cpus)
+
+    if workers is None and threads_per_job is None:
+        threads_per_job = min(DEFAULT_THREADS_PER_JOB, cpus)
+    if workers is None:
+        workers = max(1, cpus // threads_per_job)
+    if threads_per_job is None:
+        threads_per_job = max(1, cpus // workers)
+
+    return workers, threads_per_job
+
+def read_manifest(manifest_path):
+    """
+    reads the manifest csv, adding a subject column derived from the image filename if one is not given.
+    """
+    manifest = pd.read_csv(manifest_path)
+    missing = [column for column in MANIFEST_COLUMNS if column not in manifest.columns]
+    if missing:
+        raise ValueError(f"manifest is missing the columns: {missing}")
+
+    if 'subject' not in manifest.columns:
+        manifest['subject'] = [image.split(os.path.sep)[-1].split(".nii")[0] for image in manifest['image']]
+    if manifest['subject'].duplicated().any():
+        raise ValueError("subject names in the manifest must be unique")
+
+    return manifest
+
+# the template (prepared for registration) and atlas of a worker process, read once by _init_worker and reused for its subjects
+_worker_images = {}
+
+def _init_worker(threads_per_job, template, atlas, template_brainmask, crop_margin):
+    # must be set before ITK creates its global thread pool in this process
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads_per_job)
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads_per_job)
+
+    from wmhparc.registration import prepare_registration_image, read_ants
+    _worker_images['template_images'] = prepare_registration_image(template, template_brainmask, crop_margin)
+    _worker_images['atlas_image'] = read_ants(atlas)
+
+def _run_manifest_row(row, template, atlas, template_brainmask, output_folder, in_memory, write_report, options, store=None, run_name="default"):
+    from wmhparc.run_parcellation import run_subject, run_subject_in_memory, subject_report
+    from wmhparc.results_store import ResultsStore
+
+    subject_folder = os.path.join(output_folder, str(row['subject']))
+    report = subject_report(row['image'], subject_folder) if write_report else None
+    try:
+        df = (run_subject_in_memory if in_memory else run_subject)(
+            row['image'], row['brainmask'], row['synthseg'], row['wmh_seg'], template, atlas,
+            subject_folder, template_brainmask=template_brainmask, report=report, **_worker_images, **options,
+        )
+    finally:
+        if report is not None:
+            os.makedirs(subject_folder, exist_ok=True)
+            report.write(os.path.join(subject_folder, str(row['subject']) + "_run_report.json"))
+    if store is not None:
+        ResultsStore(store).upsert(df, row['subject'], run_name)
+    df.insert(0, 'subject', row['subject'])
+    return df
+
+def run_batch(manifest, template, atlas, output_folder, template_brainmask=None, cpus=None, workers=None, threads_per_job=None, use_cache=True, in_memory=False, profile='default', random_seed=None, crop_margin=None,
+              compression_level=None, save_distance_maps=True, native_spacing=True, lean_distances=False, boundaries=None, brain_volumes=False, lesion_statistics=False, write_report=False, store=None,
+              run_name="default", label_maps=None):
+    """
+    runs the parcellation for every row of the manifest dataframe over a process pool.
+    use_cache, in_memory, profile, random_seed, crop_margin, compression_level, save_distance_maps, native_spacing, lean_distances:
+    passed on to run_subject / run_subject_in_memory
+    boundaries: normalised distance boundaries between the concentric layers (default: the four default layers, see resolve_boundaries)
+    brain_volumes, lesion_statistics: also calculate the lobe, ICV and SynthSeg volumes / the lesion level statistics of each subject (see run_subject)
+    label_maps: dict of name -> path of other label maps in template space to warp with the atlas (see run_subject)
+    write_report: save a RunReport of each subject to its output folder
+    store, run_name: path of a ResultsStore each worker upserts its subject's volumes (with the brain volumes) to as
+    (subject, run_name). the store is compacted once all subjects are done.
+    returns (results, failures): a dataframe with one row of WMH volumes per subject that completed,
+    and a dict of subject -> error message for the subjects that failed.
+    """
+    workers, threads_per_job = split_cpu_budget(cpus, workers, threads_per_job)
+    print(f"processing {len(manifest)} subjects with {workers} workers x {threads_per_job} threads")
+
+    options = dict(
+        use_cache=use_cache, profile=profile, threads=threads_per_job, random_seed=random_seed, crop_margin=crop_margin,
+        compression_level=compression_level, save_distance_maps=save_distance_maps, native_spacing=native_spacing, lean_distances=lean_distances, brain_volumes=brain_volumes or store is not None,
+        lesion_statistics=lesion_statistics, label_maps=label_maps,
+    )
+    if boundaries is not None:
+        options['boundaries'] = tuple(boundaries)
+    results = []
+    failures = {}
+    # each worker reads the template and atlas once, instead of once per subject
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads_per_job, template, atlas, template_brainmask, crop_margin)) as pool:
+        futures = {
+            pool.submit(_run_manifest_row, row, template, atlas, template_brainmask, output_folder, in_memory, write_report, options, store, run_name): row['subject']
+            for row in manifest.to_dict('records')
+        }
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                results.append(future.result())
+                print(f"finished {subject} ({len(results) + len(failures)}/{len(futures)})")
+            except Exception as e:
+                failures[subject] = repr(e)
+                print(f"failed {subject}: {e}")
+
+    if store is not None:
+        from wmhparc.results_store import ResultsStore
+        ResultsStore(store).compact()
+
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['subject'])
+    # keep the manifest order regardless of completion order
+    order = {subject: idx for idx, subject in enumerate(manifest['subject'])}
+    results = results.sort_values('subject', key=lambda s: s.map(order)).reset_index(drop=True)
+    return results, failures
+
+def main(args):
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder, exist_ok=True)
+
+    from wmhparc.concentric_layers import resolve_boundaries
+    from wmhparc.utils import parse_label_maps
+
+    manifest = read_manifest(args.manifest)
+    results, failures = run_batch(
+        manifest, args.template, args.atlas, args.output_folder, template_brainmask=args.template_brainmask,
+        cpus=args.cpus, workers=args.workers, threads_per_job=args.threads_per_job, use_cache=not args.no_cache, in_memory=args.in_memory,
+        profile=args.registration_profile, random_seed=args.random_seed, crop_margin=args.crop_margin,
+        compression_level=args.compression_level, save_distance_maps=not args.no_distance_maps,
+        native_spacing=not args.resample_1mm_distances, lean_distances=args.lean_distances,
+        boundaries=resolve_boundaries(args.layers, args.layer_boundaries), brain_volumes=args.brain_volumes,
+        lesion_statistics=args.lesion_stats, write_report=args.report, store=args.store, run_name=args.run_name,
+        label_maps=parse_label_maps(args.label_maps),
+    )
+
+    results_path = args.results if args.results is not None else os.path.join(args.output_folder, "cohort_wmh_vols.csv")
+    results.to_csv(results_path, index=False)
+    print("saved cohort results to: ", results_path)
+
+    if failures:
+        failures_path = results_path.split(".csv")[0] + "_failures.csv"
+        pd.DataFrame({'subject': list(failures.keys()), 'error': list(failures.values())}).to_csv(failures_path, index=False)
+        print(f"{len(failures)} subjects failed, see: ", failures_path)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,238 @@
+"""
+Parcellation daemon: keeps a Parcellator (template and atlas in memory) running and parcellates scans as they arrive.
+
+A job is a json object with the paths image, brainmask, synthseg, wmh_seg and output_folder, and optionally
+save_intermediates. Jobs are accepted from:
+
+spool directory: job files <name>.json are dropped into <spool>/incoming (write them elsewhere and move them in, so they
+are complete when they appear). a job is claimed by moving it to <spool>/processing/<pid>-<name>.json while it runs, and its
+result written to <spool>/done/<name>.json, or <spool>/failed/<name>.json with the error. several daemons on the same
+machine can share a spool: each job is claimed by one of them, and a daemon starting up only requeues the jobs of daemons
+that are no longer running.
+
+unix socket: each connection sends one job as a line of json and receives its result as a line of json
+(see submit, or run with --submit).
+
+Jobs are run one at a time, in order of arrival.
+"""
+import os
+import json
+import time
+import glob
+import socket
+import argparse
+import threading
+import socketserver
+import traceback
+from wmhparc.registration_profiles import REGISTRATION_PROFILES, set_itk_threads
+
+JOB_FIELDS = ('image', 'brainmask', 'synthseg', 'wmh_seg', 'output_folder')
+SPOOL_FOLDERS = ('incoming', 'processing', 'done', 'failed')
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--template', default=None, type=str, help="path to the 73yr T1w template image")
+    parser.add_argument('-a', '--atlas', default=None, type=str, help="path to the brainlobe atlas")
+    parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
+    parser.add_argument('--spool', default=None, type=str, help="spool directory to take jobs from (<spool>/incoming/*.json)")
+    parser.add_argument('--socket', default=None, type=str, help="path of a unix socket to accept jobs on")
+    parser.add_argument('--poll_interval', default=1.0, type=float, help="seconds between checks of the spool directory for new jobs")
+    parser.add_argument('--submit', default=None, type=str, help="instead of running the daemon, send this job json file to the daemon listening on --socket and print the result")
+    parser.add_argument('-p', '--registration_profile', default='default', choices=list(REGISTRATION_PROFILES.keys()), help="registration speed / accuracy profile")
+    parser.add_argument('--threads', default=None, type=int, help="number of ITK threads used for registration (default: all available)")
+    parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration, for reproducible runs")
+    parser.add_argument('--crop_margin', default=None, type=int, help="crop to the brainmask bounding box padded by this many voxels for registration and atlas warping")
+    parser.add_argument('--compression_level', default=None, type=int, choices=range(10), help="gzip level (1-9) of the output images, 0 to write uncompressed .nii files")
+    parser.add_argument('--lean_distances', action='store_true', help="compute the distance maps cropped to the brain, concurrently and as float32")
+    parser.add_argument('--layers', default=None, type=int, help="number of equidistant concentric layers (default: 4)")
+    parser.add_argument('--layer_boundaries', default=None, nargs='+', type=float, help="instead of --layers, the normalised distance boundaries between the layers")
+    parser.add_argument('--label_maps', default=None, nargs='+', type=str, help="other label maps in template space to warp along with the atlas in one pass, as name=path (saved as <image>_<name>)")
+    parser.add_argument('--report', action='store_true', help="save a json report of the resources used by each stage to each job's output folder")
+    parser.add_argument('--no_cache', action='store_true', help="rerun every stage even if its inputs are unchanged since the last run in the output folder")
+
+    return parser
+
+def run_job(parcellator, job, lock, write_report=False):
+    """
+    runs a job (a dict with the JOB_FIELDS) with the parcellator, holding lock so jobs run one at a time.
+    returns the result as a json serialisable dict, with status 'done' and the volumes, or status 'failed' and the error.
+    """
+    start = time.perf_counter()
+    try:
+        if not isinstance(job, dict):
+            raise ValueError(f"a job must be a json object, not {type(job).__name__}")
+        missing = [field for field in JOB_FIELDS if field not in job]
+        if missing:
+            raise ValueError(f"job is missing the fields {missing}")
+        report = None
+        if write_report:
+            from wmhparc.run_parcellation import subject_report
+            report = subject_report(job['image'], job['output_folder'])
+        with lock:
+            try:
+                df = parcellator.run(
+                    job['image'], job['brainmask'], job['synthseg'], job['wmh_seg'], job['output_folder'],
+                    save_intermediates=job.get('save_intermediates', False), report=report,
+                )
+            finally:
+                if report is not None:
+                    os.makedirs(job['output_folder'], exist_ok=True)
+                    report.write(os.path.join(job['output_folder'], report.subject + "_run_report.json"))
+        result = {'status': 'done', 'volumes': {key: float(value) for key, value in df.iloc[0].items()}}
+    except Exception as e:
+        traceback.print_exc()
+        result = {'status': 'failed', 'error': repr(e)}
+    result['wall_time_s'] = time.perf_counter() - start
+    return result
+
+def _write_json(data, filepath):
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, filepath)
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def init_spool(spool):
+    """
+    creates the spool folders, and requeues the jobs left in processing by daemons that stopped mid job
+    (jobs claimed by a daemon that is still running are left to it)
+    """
+    for folder in SPOOL_FOLDERS:
+        os.makedirs(os.path.join(spool, folder), exist_ok=True)
+    for job_file in glob.glob(os.path.join(spool, "processing", "*.json")):
+        owner, _, name = os.path.basename(job_file).partition("-")
+        if not owner.isdigit() or not name:
+            continue
+        if int(owner) != os.getpid() and _pid_running(int(owner)):
+            continue
+        try:
+            os.replace(job_file, os.path.join(spool, "incoming", name))
+        except FileNotFoundError:
+            # requeued by another daemon starting up
+            continue
+        print("requeuing interrupted job: ", name)
+
+def process_spool(parcellator, spool, lock, write_report=False):
+    """runs the jobs currently in <spool>/incoming, oldest first. returns the number of jobs run"""
+    job_files = []
+    for job_file in glob.glob(os.path.join(spool, "incoming", "*.json")):
+        try:
+            job_files.append((os.path.getmtime(job_file), job_file))
+        except FileNotFoundError:
+            # claimed by another daemon sharing the spool
+            continue
+
+    n_run = 0
+    for _, job_file in sorted(job_files):
+        name = os.path.basename(job_file)
+        processing_file = os.path.join(spool, "processing", f"{os.getpid()}-{name}")
+        try:
+            # claims the job, so it is run once even if several daemons share the spool
+            os.replace(job_file, processing_file)
+        except FileNotFoundError:
+            continue
+        n_run += 1
+
+        print(f"running job {name}")
+        try:
+            with open(processing_file) as f:
+                job = json.load(f)
+        except ValueError as e:
+            job, result = {}, {'status': 'failed', 'error': f"could not read job file: {e!r}", 'wall_time_s': 0.0}
+        else:
+            result = run_job(parcellator, job, lock, write_report)
+
+        _write_json({**result, 'job': job}, os.path.join(spool, "done" if result['status'] == 'done' else "failed", name))
+        try:
+            os.remove(processing_file)
+        except FileNotFoundError:
+            pass
+        print(f"job {name} {result['status']} in {result['wall_time_s']:.1f} s")
+    return n_run
+
+def serve_socket(parcellator, socket_path, lock, write_report=False):
+    """starts a unix socket server for jobs in a background thread, returns the server (stop it with server.shutdown())"""
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                job = json.loads(self.rfile.readline())
+            except ValueError as e:
+                result = {'status': 'failed', 'error': f"could not read job: {e!r}", 'wall_time_s': 0.0}
+            else:
+                print(f"running job for {job.get('image') if isinstance(job, dict) else job}")
+                result = run_job(parcellator, job, lock, write_report)
+            self.wfile.write((json.dumps(result) + "\n").encode())
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("accepting jobs on socket: ", socket_path)
+    return server
+
+def submit(socket_path, job):
+    """sends a job to a daemon listening on socket_path, waits for it to run and returns the result"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(job) + "\n").encode())
+        with client.makefile("r") as f:
+            return json.loads(f.readline())
+
+def main(args):
+    if args.submit is not None:
+        if args.socket is None:
+            raise ValueError("--socket is required with --submit")
+        with open(args.submit) as f:
+            result = submit(args.socket, json.load(f))
+        print(json.dumps(result, indent=2))
+        return 0 if result['status'] == 'done' else 1
+
+    if args.template is None or args.atlas is None:
+        raise ValueError("--template and --atlas are required to run the daemon")
+    if args.spool is None and args.socket is None:
+        raise ValueError("at least one of --spool or --socket must be given")
+
+    # imported here so that submitting a job does not import ants, and the thread budget is set before ants is imported
+    if args.threads is not None:
+        set_itk_threads(args.threads)
+    from wmhparc.parcellator import Parcellator
+    from wmhparc.concentric_layers import resolve_boundaries
+    from wmhparc.utils import parse_label_maps
+    parcellator = Parcellator(
+        args.template, args.atlas, args.template_brainmask, profile=args.registration_profile, threads=args.threads,
+        random_seed=args.random_seed, crop_margin=args.crop_margin, use_cache=not args.no_cache,
+        lean_distances=args.lean_distances, compression_level=args.compression_level,
+        boundaries=resolve_boundaries(args.layers, args.layer_boundaries), label_maps=parse_label_maps(args.label_maps),
+    )
+    lock = threading.Lock()
+
+    server = serve_socket(parcellator, args.socket, lock, args.report) if args.socket is not None else None
+    if args.spool is not None:
+        init_spool(args.spool)
+        print("watching spool directory: ", args.spool)
+    try:
+        while True:
+            if args.spool is None or process_spool(parcellator, args.spool, lock, args.report) == 0:
+                time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print("stopping")
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            os.remove(args.socket)
+    return 0
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    raise SystemExit(main(args))
@@ -0,0 +1,125 @@
+"""
+Longitudinal bullseye parcellation of several visits of one subject.
+
+The template is registered once, to a reference image (the baseline visit, or a subject specific template such as
+a midpoint image). Each visit is then only rigidly (or affinely) aligned to the reference, and the lobe atlas is warped
+into each visit through the composed visit -> reference -> template transforms.
+"""
+import os
+import argparse
+import pandas as pd
+from wmhparc.registration_profiles import REGISTRATION_PROFILES, set_itk_threads
+from wmhparc.concentric_layers import resolve_boundaries, RING_BOUNDARIES
+from wmhparc.utils import parse_label_maps
+from wmhparc.stage_cache import StageCache
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', required=True, nargs='+', type=str, help="paths to the anatomical images of each visit, baseline first")
+    parser.add_argument('-b', '--brainmasks', required=True, nargs='+', type=str, help="paths to the brainmask (ICV) of each visit")
+    parser.add_argument('-s', '--synthsegs', required=True, nargs='+', type=str, help="paths to the SynthSeg output of each visit")
+    parser.add_argument('-w', '--wmh_segs', required=True, nargs='+', type=str, help="paths to the WMH segmentation of each visit")
+    parser.add_argument('-t', '--template', required=True, type=str, help="path to the 73yr T1w template image")
+    parser.add_argument('-a', '--atlas', required=True, type=str, help="path to the brainlobe atlas")
+    parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
+    parser.add_argument('-r', '--reference', default=None, type=str, help="image the template is registered to (default: the first visit), e.g a subject specific midpoint template")
+    parser.add_argument('-rb', '--reference_brainmask', default=None, type=str, help="brainmask of the reference image (default: the brainmask of the first visit if no reference is given)")
+    parser.add_argument('--affine', action='store_true', help="align the visits to the reference with an affine instead of a rigid transform")
+    parser.add_argument('-p', '--registration_profile', default='default', choices=list(REGISTRATION_PROFILES.keys()), help="registration speed / accuracy profile of the template registration")
+    parser.add_argument('--threads', default=None, type=int, help="number of ITK threads used for registration")
+    parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration, for reproducible runs")
+    parser.add_argument('--compression_level', default=None, type=int, choices=range(10), help="gzip level (1-9) of the output images, 0 to write uncompressed .nii files")
+    parser.add_argument('--no_distance_maps', action='store_true', help="do not save the ventricle and cortex distance maps")
+    parser.add_argument('--layers', default=None, type=int, help="number of equidistant concentric layers (default: 4)")
+    parser.add_argument('--layer_boundaries', default=None, nargs='+', type=float, help="instead of --layers, the normalised distance boundaries between the layers")
+    parser.add_argument('--label_maps', default=None, nargs='+', type=str, help="other label maps in template space to warp along with the atlas in one pass, as name=path (saved as <image>_<name>)")
+    parser.add_argument('--no_cache', action='store_true', help="rerun every stage even if its inputs are unchanged since the last run")
+    parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder, the reference registration and each visit are saved to subfolders")
+
+    return parser
+
+def _visit_name(image):
+    return image.split(os.path.sep)[-1].split(".nii")[0]
+
+def align_visit(image, reference, output_folder, rigid=True, threads=None, random_seed=None):
+    """
+    rigidly (or affinely) registers the reference image to a visit image, returns the list of transforms [affine]
+    """
+    from wmhparc.registration import run_ants
+
+    out = os.path.join(output_folder, _visit_name(image) + "_reference_to_visit.nii.gz")
+    run_ants(fixed=image, moving=reference, out=out, save=False, normalize=True, rigid=rigid, threads=threads, random_seed=random_seed)
+    return [out.split(".nii")[0] + "_0GenericAffine.mat"]
+
+def run_longitudinal(images, brainmasks, synthsegs, wmh_segs, template, atlas, output_folder, template_brainmask=None, reference=None, reference_brainmask=None,
+                     rigid=True, use_cache=True, profile='default', threads=None, random_seed=None, compression_level=None, save_distance_maps=True,
+                     boundaries=RING_BOUNDARIES, label_maps=None):
+    """
+    runs the parcellation for each visit of a subject, registering the template only once to the reference image.
+    returns the WMH bullseye volumes as a dataframe with one row per visit.
+    compression_level, save_distance_maps, boundaries, label_maps: see run_subject
+    """
+    # imported here, so the thread budget can be set before ants is imported (see main)
+    from wmhparc.run_parcellation import cached_registration, run_subject_from_transforms
+
+    if not (len(images) == len(brainmasks) == len(synthsegs) == len(wmh_segs)):
+        raise ValueError("the same number of images, brainmasks, synthsegs and wmh_segs must be given")
+    if reference is None:
+        reference, reference_brainmask = images[0], brainmasks[0]
+
+    reference_folder = os.path.join(output_folder, "reference")
+    os.makedirs(reference_folder, exist_ok=True)
+    reference_cache = StageCache(reference_folder, enabled=use_cache)
+    template_transforms, registration_key = cached_registration(
+        reference_cache, reference, template, reference_folder, reference_brainmask, template_brainmask,
+        profile=profile, threads=threads, random_seed=random_seed,
+    )
+
+    results = []
+    for image, brainmask, synthseg, wmh_seg in zip(images, brainmasks, synthsegs, wmh_segs):
+        visit = _visit_name(image)
+        print(f"processing visit {visit}")
+        visit_folder = os.path.join(output_folder, visit)
+        os.makedirs(visit_folder, exist_ok=True)
+        cache = StageCache(visit_folder, enabled=use_cache)
+
+        if os.path.abspath(image) == os.path.abspath(reference):
+            transforms, transforms_keys = list(template_transforms), [registration_key]
+        else:
+            visit_transforms, alignment_key = cache.run(
+                "visit_alignment",
+                lambda: align_visit(image, reference, visit_folder, rigid=rigid, threads=threads, random_seed=random_seed),
+                input_files={'image': image, 'reference': reference},
+                params={'rigid': rigid, 'random_seed': random_seed},
+            )
+            # the reference -> visit alignment is applied after the template -> reference transforms
+            transforms, transforms_keys = list(template_transforms) + list(visit_transforms), [registration_key, alignment_key]
+
+        df = run_subject_from_transforms(
+            image, brainmask, synthseg, wmh_seg, atlas, visit_folder, transforms, cache, transforms_keys,
+            compression_level=compression_level, save_distance_maps=save_distance_maps, boundaries=boundaries,
+            label_maps=label_maps,
+        )
+        df.insert(0, 'visit', visit)
+        results.append(df)
+
+    return pd.concat(results, ignore_index=True)
+
+def main(args):
+    if args.threads is not None:
+        set_itk_threads(args.threads)
+    df = run_longitudinal(
+        args.images, args.brainmasks, args.synthsegs, args.wmh_segs, args.template, args.atlas, args.output_folder,
+        template_brainmask=args.template_brainmask, reference=args.reference, reference_brainmask=args.reference_brainmask,
+        rigid=not args.affine, use_cache=not args.no_cache, profile=args.registration_profile, threads=args.threads, random_seed=args.random_seed,
+        compression_level=args.compression_level, save_distance_maps=not args.no_distance_maps,
+        boundaries=resolve_boundaries(args.layers, args.layer_boundaries), label_maps=parse_label_maps(args.label_maps),
+    )
+    out_path = os.path.join(args.output_folder, "longitudinal_wmh_vols.csv")
+    df.to_csv(out_path, index=False)
+    print("saved longitudinal results to: ", out_path)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
@@ -4,9 +4,20 @@ Register the template image to the target image.
 Apply the registration transform to the atlas image.
 """
 import os
-from wmhparc.registration import run_ants_SyNAggro, apply_ants_transforms
-from wmhparc.concentric_layers import postprocess_synthseg, create_pv_dist_ring_file
-from wmhparc.parcellate_image import save_brain_parcellation_image, calc_parc_stats
+from wmhparc.registration import run_ants_SyNAggro, apply_ants_transforms, compose_transforms, apply_displacement_field, ants_to_sitk, REGISTRATION_PROFILES
+from wmhparc.concentric_layers import (
+    postprocess_synthseg, create_pv_dist_ring_file, create_norm_dist_file, create_norm_dist_file_from_synthseg, create_pv_rings_from_norm_dist,
+    distance_maps_in_image_space, saved_distance_image, norm_dist_array, ring_labels, norm_dist_image, resolve_boundaries, layering_suffix, RING_BOUNDARIES,
+)
+from wmhparc.parcellate_image import save_brain_parcellation_image, calc_parc_stats, calc_all_brain_volumes, get_all_brain_volumes, bullseye_labels, parc_stats
+from wmhparc.utils import fileending, output_ending, write_image, image_from_array, load_image, read_image, read_header, image_cache, same_grid, resample_to_reference, resample_to_spacing, parse_label_maps
+import SimpleITK as sitk
+import numpy as np
+from wmhparc.stage_cache import StageCache
+from wmhparc.instrumentation import RunReport, measure, cprofile_hook, image_info
+from wmhparc.results_store import ResultsStore
+from wmhparc.lesion_stats import lesion_stats, save_lesion_stats
+import pandas as pd
 import argparse
 
 def construct_parser():
@@ -19,22 +30,109 @@ def construct_parser():
     parser.add_argument('-tb', '--template_brainmask', default=None, type=str, help="path to the brainmask (ICV) for the template image")
     parser.add_argument('-w', '--wmh_seg', required=True, type=str, help="path to the WMH segmentation file")
     parser.add_argument('-o', '--output_folder', required=True, type=str, help="output folder to save results to")
+    parser.add_argument('-p', '--registration_profile', default='default', choices=list(REGISTRATION_PROFILES.keys()), help="registration speed / accuracy profile")
+    parser.add_argument('--threads', default=None, type=int, help="number of ITK threads used for registration (default: all available)")
+    parser.add_argument('--random_seed', default=None, type=int, help="random seed for registration, for reproducible runs")
+    parser.add_argument('--crop_margin', default=None, type=int, help="crop the subject and template images to their brainmask bounding box padded by this many voxels for registration and atlas warping (default: no cropping)")
+    parser.add_argument('--label_maps', default=None, nargs='+', type=str, help="other label maps in template space to warp to the subject image along with the atlas, as name=path (e.g lobes_no_bgit=atlas.nii.gz template_synthseg=synthseg.nii.gz), saved as <image>_<name>. the registration transforms are composed into one displacement field, applied to all of them in one pass")
+    parser.add_argument('--report', action='store_true', help="save a json report of the time, cpu, memory and IO used by each stage to the output folder")
+    parser.add_argument('--profile_stages', action='store_true', help="with --report, also save a cProfile of each stage to <output_folder>/profiles")
+    parser.add_argument('--no_cache', action='store_true', help="rerun every stage even if its inputs are unchanged since the last run in the output folder")
+    parser.add_argument('--resample_1mm_distances', action='store_true', help="compute the distance maps on a 1x1x1 reslice of the synthseg image and resample them back, instead of at the native voxel spacing of the image")
+    parser.add_argument('--lean_distances', action='store_true', help="compute the distance maps cropped to the brain, concurrently and as float32 to reduce peak memory (values outside the brain are nan)")
+    parser.add_argument('--compression_level', default=None, type=int, choices=range(10), help="gzip level (1-9) of the output images, 0 to write uncompressed .nii files (default: the ITK default level, and the file ending of the input image for the distance maps and layers)")
+    parser.add_argument('--no_distance_maps', action='store_true', help="do not save the ventricle and cortex distance maps, only the concentric layers computed from them")
+    parser.add_argument('--layers', default=None, type=int, help="number of equidistant concentric layers (default: 4)")
+    parser.add_argument('--layer_boundaries', default=None, nargs='+', type=float, help="instead of --layers, the normalised distance boundaries between the layers, e.g 0.2 0.5 0.8. outputs of non default layerings are named with a suffix, e.g _pvrings_5layers")
+    parser.add_argument('--brain_volumes', action='store_true', help="also calculate the gray and white matter lobe volumes, ICV and SynthSeg volumes, saved as *_brain_vols.csv")
+    parser.add_argument('--lesion_stats', action='store_true', help="also calculate lesion level statistics (lesion counts, size distribution and spanning lesions) per bullseye region, saved as *_lesions.csv and *_lesion_regions.csv")
+    parser.add_argument('--store', default=None, type=str, help="upsert the volumes (with --brain_volumes) to the cohort results store in this folder, see results_store.py. the store is compacted once COMPACT_THRESHOLD subjects have been upserted since the last compaction")
+    parser.add_argument('--run_name', default="default", type=str, help="name of the run the volumes are stored under in the results store, e.g to keep several layerings of a subject")
+    parser.add_argument('--preview', action='store_true', help="quick approximate run for triage: registration (fast profile), distance maps and parcellation on a downsampled grid, with the parcellation mapped back to the WMH segmentation grid for the stats. outputs are saved to <output_folder>/preview (--label_maps is not supported)")
+    parser.add_argument('--preview_spacing', default=2.5, type=float, help="voxel spacing (mm) of the preview grid")
+    parser.add_argument('--preview_validate', action='store_true', help="with --preview, also run the full pipeline and report how far the preview volumes deviate from it (without it, an existing full run in the output folder is compared against)")
+    parser.add_argument('--in_memory', action='store_true', help="pass images between the stages in memory instead of through intermediate files (only the registration transforms, parcellation and stats are written)")
+    parser.add_argument('--save_intermediates', action='store_true', help="with --in_memory, also write the lobe atlas, distance maps and concentric layers images")
 
     return parser
 
-def register_and_apply(image, template, atlas, output_folder, image_mask=None, template_mask=None):
+def _lobe_atlas_path(image, output_folder, ending=".nii.gz"):
+    return os.path.join(output_folder, image.split(os.path.sep)[-1].split(".nii")[0] + "_lobe_atlas" + ending)
 
-    out_image = os.path.join(output_folder, image.split(os.path.sep)[-1].split(".nii")[0] + "_lobe_atlas.nii.gz")
-    run_ants_SyNAggro(fixed=image, moving=template, out=out_image, outsuffix="template_synaggro", mask=image_mask, moving_mask=template_mask)
+def register_template(image, template, output_folder, image_mask=None, template_mask=None, profile='default', threads=None, random_seed=None, crop_margin=None, template_images=None):
+    """
+    registers the template to the subject image, returns the list of transforms [affine, warp]
+    profile, threads, random_seed, crop_margin: see run_ants_SyNAggro
+    template_images: optional (template, template mask) ANTsImages from prepare_registration_image (with the same crop_margin),
+    used instead of reading and normalising the template
+    """
+    out_image = _lobe_atlas_path(image, output_folder)
+    if template_images is not None:
+        template, template_mask = template_images
+    run_ants_SyNAggro(
+        fixed=image, moving=template, out=out_image, outsuffix="template_synaggro", mask=image_mask, moving_mask=template_mask,
+        profile=profile, threads=threads, random_seed=random_seed, crop_margin=crop_margin, moving_prepared=template_images is not None,
+    )
 
     affine_transform = out_image.split(".nii")[0] + "_template_synaggro_0GenericAffine.mat"
     warp_transform = out_image.split(".nii")[0] + "_template_synaggro_1Warp.nii.gz"
+    return [affine_transform, warp_transform]
+
+def warp_atlas(image, atlas, transforms, output_folder, image_mask=None, crop_margin=None, compression_level=None):
+    """
+    warps the atlas to the subject image, if crop_margin is given the atlas is only resampled
+    within the image_mask bounding box padded by crop_margin voxels.
+    the atlas is saved as an integer label image, compression_level: see write_image
+    """
+    out_image = _lobe_atlas_path(image, output_folder, output_ending(compression_level))
 
     print("applying ants transform")
-    apply_ants_transforms(image, atlas, out_image, [affine_transform, warp_transform], is_label=True)
+    crop_mask = image_mask if crop_margin is not None else None
+    transformed = apply_ants_transforms(image, atlas, None, list(transforms), is_label=True, write=False, crop_mask=crop_mask, crop_margin=crop_margin)
+    write_image(ants_to_sitk(transformed), out_image, kind='label', compression_level=compression_level)
 
     print("transformed atlas saved to: ", out_image)
-    return out_image 
+    return out_image
+
+def _composed_transform_prefix(image, output_folder):
+    return os.path.join(output_folder, image.split(os.path.sep)[-1].split(".nii")[0] + "_template_")
+
+def _check_label_map_names(label_maps):
+    if 'lobe_atlas' in label_maps:
+        raise ValueError("lobe_atlas is the name of the warped atlas, choose another name for the label map")
+
+def warp_label_maps(image, label_maps, field, output_folder, compression_level=None):
+    """
+    warps several label maps to the subject image in one pass with the displacement field of compose_transforms.
+    label_maps: dict of name -> label map in template space (path or sitk image), each saved as <image>_<name>
+    returns a dict of name -> path of the warped label map
+    """
+    imagename = image.split(os.path.sep)[-1].split(".nii")[0]
+
+    print(f"applying composed transform to {len(label_maps)} label maps")
+    warped = apply_displacement_field(read_header(image), label_maps, field, is_label=True)
+    out_paths = {}
+    for name, label_map in warped.items():
+        out_paths[name] = os.path.join(output_folder, imagename + "_" + name + output_ending(compression_level))
+        write_image(label_map, out_paths[name], kind='label', compression_level=compression_level)
+        print("transformed label map saved to: ", out_paths[name])
+    return out_paths
+
+def register_and_apply(image, template, atlas, output_folder, image_mask=None, template_mask=None, profile='default', threads=None, random_seed=None, crop_margin=None, compression_level=None,
+                       label_maps=None):
+    """
+    registers the template to the subject image and warps the atlas to it, returns the path of the warped atlas.
+    label_maps: optional dict of name -> path of other label maps in template space. the transforms are then composed once
+    and the atlas and label maps all warped with the composed field (see warp_label_maps)
+    """
+    transforms = register_template(image, template, output_folder, image_mask=image_mask, template_mask=template_mask, profile=profile, threads=threads, random_seed=random_seed, crop_margin=crop_margin)
+    if not label_maps:
+        return warp_atlas(image, atlas, transforms, output_folder, image_mask=image_mask, crop_margin=crop_margin, compression_level=compression_level)
+
+    _check_label_map_names(label_maps)
+    crop_mask = image_mask if crop_margin is not None else None
+    field = compose_transforms(image, list(transforms), _composed_transform_prefix(image, output_folder), crop_mask=crop_mask, crop_margin=crop_margin)
+    return warp_label_maps(image, {'lobe_atlas': atlas, **label_maps}, field, output_folder, compression_level)['lobe_atlas']
 
 def compute_concentric_layers(image, synthseg, brainmask, output_folder):
     print("computing ventricle and cortex distance transforms")
@@ -45,24 +143,487 @@ def compute_concentric_layers(image, synthseg, brainmask, output_folder):
 
     return pv_rings_file
 
-def main(args):
+def save_parc_stats(image, parc_file, wmh_seg, n_layers=len(RING_BOUNDARIES) + 1):
+    df = calc_parc_stats(image, parc_file, wmh_seg, n_layers)
+    stats_file = parc_file.split(".nii")[0] + "_wmh_vols.csv"
+    df.to_csv(stats_file)
+    return stats_file
+
+def save_brain_volumes(image, parc_file, wmh_seg, atlas_file, synthseg, brainmask, n_layers=len(RING_BOUNDARIES) + 1):
+    df = calc_all_brain_volumes(image, parc_file, wmh_seg, atlas_file, synthseg, brainmask, n_layers)
+    volumes_file = parc_file.split(".nii")[0] + "_brain_vols.csv"
+    df.to_csv(volumes_file)
+    return volumes_file
+
+def cached_registration(cache, image, template, output_folder, brainmask, template_brainmask, profile='default', threads=None, random_seed=None, crop_margin=None, template_images=None):
+    """
+    runs the registration stage through a StageCache, returns (transforms, stage key)
+    template_images: optional preloaded template, see register_template. the stage is still keyed by the template files.
+    """
+    return cache.run(
+        "registration",
+        lambda: register_template(
+            image, template, output_folder, image_mask=brainmask, template_mask=template_brainmask, profile=profile, threads=threads,
+            random_seed=random_seed, crop_margin=crop_margin, template_images=template_images,
+        ),
+        input_files={'image': image, 'template': template, 'image_mask': brainmask, 'template_mask': template_brainmask},
+        params={'profile': profile, 'random_seed': random_seed, 'crop_margin': crop_margin},
+    )
+
+def cached_composed_transform(cache, image, transforms, transforms_keys, output_folder, brainmask, crop_margin=None):
+    """
+    composes the registration transforms into one displacement field (see compose_transforms) through a StageCache,
+    so the field is only written once for the transforms. returns (path of the field, stage key)
+    """
+    crop_mask = brainmask if crop_margin is not None else None
+    return cache.run(
+        "composed_transform",
+        lambda: compose_transforms(image, list(transforms), _composed_transform_prefix(image, output_folder), crop_mask=crop_mask, crop_margin=crop_margin),
+        input_files={'image': image, 'image_mask': crop_mask},
+        params={'crop_margin': crop_margin},
+        upstream=transforms_keys,
+    )
+
+@image_cache()
+def run_subject_in_memory(image, brainmask, synthseg, wmh_seg, template, atlas, output_folder, template_brainmask=None, use_cache=True, save_intermediates=False, native_spacing=True, lean_distances=False,
+                          compression_level=None, save_distance_maps=True, report=None, template_images=None, atlas_image=None, boundaries=RING_BOUNDARIES, brain_volumes=False,
+                          lesion_statistics=False, label_maps=None, **registration_options):
+    """
+    runs the parcellation pipeline passing sitk images and arrays between the stages instead of intermediate files.
+    only the registration (which is cached as in run_subject), the bullseye parcellation image and the stats csv
+    are written, unless save_intermediates is True (the distance maps are only saved if save_distance_maps is also True).
+    returns the WMH bullseye volumes as a one row dataframe.
+    boundaries: normalised distance boundaries between the concentric layers (see resolve_boundaries)
+    brain_volumes: also calculate the lobe, ICV and SynthSeg volumes (see get_all_brain_volumes), saved as *_brain_vols.csv
+    and returned instead of only the WMH volumes
+    lesion_statistics: also calculate the lesion level statistics (see lesion_stats), saved as *_lesions.csv and *_lesion_regions.csv
+    compression_level: gzip level of the output images, 0 to write uncompressed .nii files (see write_image)
+    report: optional RunReport the resources used by each stage are recorded in
+    template_images, atlas_image: optional preloaded template (see register_template) and ANTsImage of the atlas, used
+    instead of reading them (template and atlas are still needed, to key the cached registration)
+    label_maps: optional dict of name -> label map in template space (path or sitk image) to warp along with the atlas in one
+    pass through the composed registration transforms (see warp_label_maps). the warped label maps are always saved.
+    registration_options: profile, threads, random_seed and crop_margin, see run_ants_SyNAggro
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    imagename = image.split(os.path.sep)[-1].split(".nii")[0]
+    filetype = output_ending(compression_level, fileending(image))
+    def out_path(suffix, ending=filetype):
+        return os.path.join(output_folder, imagename + suffix + ending)
+    layering = layering_suffix(boundaries)
+
+    cache = StageCache(output_folder, enabled=use_cache, report=report)
+    transforms, transforms_key = cached_registration(cache, image, template, output_folder, brainmask, template_brainmask, template_images=template_images, **registration_options)
+
+    # only the grid of the subject image is needed
+    image_img = read_header(image)
+    print("applying ants transform")
+    with measure(report, "atlas_warp"):
+        crop_margin = registration_options.get('crop_margin')
+        crop_mask = brainmask if crop_margin is not None else None
+        if not label_maps:
+            atlas_img = ants_to_sitk(apply_ants_transforms(image, atlas_image if atlas_image is not None else atlas, None, list(transforms), is_label=True, write=False, crop_mask=crop_mask, crop_margin=crop_margin), image_img)
+        else:
+            _check_label_map_names(label_maps)
+            field, _ = cached_composed_transform(cache, image, transforms, [transforms_key], output_folder, brainmask, crop_margin)
+            warped = apply_displacement_field(image_img, {'lobe_atlas': ants_to_sitk(atlas_image) if atlas_image is not None else atlas, **label_maps}, field, is_label=True)
+            atlas_img = warped.pop('lobe_atlas')
+            for name, label_map in warped.items():
+                write_image(label_map, out_path("_" + name, output_ending(compression_level)), kind='label', compression_level=compression_level)
+
+    print("computing ventricle and cortex distance transforms")
+    with measure(report, "distance_maps"):
+        synthseg_img = read_image(synthseg)
+        brainmask_img = read_image(brainmask)
+        vent_dist_img, cortex_dist_img = distance_maps_in_image_space(image_img, synthseg_img, native_spacing=native_spacing, lean=lean_distances, mask_img=brainmask_img)
+
+    # the layers are made from the normalised distance along with the parcellation, the layers image only if it is saved
+    with measure(report, "layers"):
+        norm_dist = norm_dist_array(vent_dist_img, cortex_dist_img)
+
+    with measure(report, "parcellation"):
+        brainmask = sitk.GetArrayFromImage(brainmask_img) == 1
+        brain_rois = bullseye_labels(norm_dist, brainmask, sitk.GetArrayFromImage(atlas_img), boundaries)
+
+        if save_intermediates:
+            write_image(atlas_img, out_path("_lobe_atlas", output_ending(compression_level)), kind='label', compression_level=compression_level)
+            if save_distance_maps:
+                write_image(saved_distance_image(vent_dist_img), out_path("_ventdist"), kind='distance', compression_level=compression_level)
+                write_image(saved_distance_image(cortex_dist_img), out_path("_cortexdist"), kind='distance', compression_level=compression_level)
+            write_image(norm_dist_image(norm_dist, brainmask, vent_dist_img), out_path("_normdist"), kind='distance', compression_level=compression_level)
+            write_image(image_from_array(ring_labels(norm_dist, brainmask, boundaries), vent_dist_img), out_path("_pvrings" + layering), kind='label', compression_level=compression_level)
+        del norm_dist
+
+        parc_file = out_path("_bullseye_parc" + layering, output_ending(compression_level))
+        write_image(image_from_array(brain_rois, atlas_img), parc_file, kind='label', compression_level=compression_level)
+        print("saved bullseye parcellation image to: ", parc_file)
+
+    with measure(report, "stats"):
+        df = parc_stats(brain_rois, load_image(wmh_seg), np.prod(image_img.GetSpacing()), len(boundaries) + 1)
+        df.to_csv(parc_file.split(".nii")[0] + "_wmh_vols.csv")
+
+    if lesion_statistics:
+        with measure(report, "lesion_stats"):
+            lesion_table, region_table = lesion_stats(load_image(wmh_seg), brain_rois, np.prod(image_img.GetSpacing()), len(boundaries) + 1)
+            lesion_table.to_csv(parc_file.split(".nii")[0] + "_lesions.csv", index=False)
+            region_table.to_csv(parc_file.split(".nii")[0] + "_lesion_regions.csv", index=False)
+
+    if brain_volumes:
+        with measure(report, "brain_volumes"):
+            if not same_grid(synthseg_img, image_img):
+                synthseg_img = resample_to_reference(synthseg_img, image_img, use_nearest_neighbor=True)
+            data = {
+                'brainroi': brain_rois, 'wmh': load_image(wmh_seg), 'atlas': sitk.GetArrayViewFromImage(atlas_img),
+                'synthseg': sitk.GetArrayViewFromImage(synthseg_img), 'brainmask': brainmask, 'voxel_size': np.prod(image_img.GetSpacing()),
+            }
+            volumes = get_all_brain_volumes(data, len(boundaries) + 1)
+            df = pd.DataFrame({key: [value] for key, value in volumes.items()})
+            df.to_csv(parc_file.split(".nii")[0] + "_brain_vols.csv")
+
+    return df
+
+def run_subject(image, brainmask, synthseg, wmh_seg, template, atlas, output_folder, template_brainmask=None, use_cache=True, native_spacing=True, lean_distances=False,
+                compression_level=None, save_distance_maps=True, report=None, boundaries=RING_BOUNDARIES, brain_volumes=False, lesion_statistics=False, label_maps=None,
+                template_images=None, atlas_image=None, **registration_options):
+    """
+    runs the full parcellation pipeline for one subject and returns the WMH bullseye volumes as a one row dataframe.
+    the dataframe is also saved next to the parcellation image as *_wmh_vols.csv
+
+    the pipeline runs as the stages: registration, atlas_warp, distance_maps, normdist, layers, parcellation and stats.
+    a stage is skipped if its inputs, parameters and upstream stages are unchanged since the last run in
+    output_folder (unless use_cache is False), so e.g. a new wmh_seg only reruns the stats stage, and new
+    layer boundaries only rerun the layers, parcellation and stats stages from the saved normalised distance map.
+    each image is decoded at most once during the stages after registration (see image_cache).
+
+    compression_level: gzip level of the output images, 0 to write uncompressed .nii files (see write_image)
+    save_distance_maps: if False the distance maps are computed in memory in the normdist stage and not saved
+    boundaries: normalised distance boundaries between the concentric layers (see resolve_boundaries)
+    brain_volumes: also run the brain_volumes stage, which calculates the lobe, ICV and SynthSeg volumes (see get_all_brain_volumes)
+    and saves them with the WMH volumes as *_brain_vols.csv. this dataframe is then returned instead.
+    lesion_statistics: also run the lesion_stats stage, which saves lesion level statistics per bullseye region (see lesion_stats)
+    label_maps: optional dict of name -> path of other label maps in template space (e.g the atlas without the bgit region or the
+    template synthseg). the registration transforms are then composed into one displacement field in the composed_transform
+    stage, and the atlas and label maps are all warped with it in the atlas_warp stage (see warp_label_maps)
+    report: optional RunReport the resources used by each stage are recorded in
+    template_images, atlas_image: optional preloaded template (see register_template) and ANTsImage of the atlas, used
+    instead of reading them (the stages are still keyed by the template and atlas files)
+    registration_options: profile, threads, random_seed and crop_margin, see run_ants_SyNAggro
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
 
-    if not os.path.exists(args.output_folder):
-        os.makedirs(args.output_folder, exist_ok=True)
+    cache = StageCache(output_folder, enabled=use_cache, report=report)
     
     # registration
-    registered_atlas_file = register_and_apply(args.image, args.template, args.atlas, args.output_folder, image_mask=args.brainmask, template_mask=args.template_brainmask)
+    transforms, registration_key = cached_registration(cache, image, template, output_folder, brainmask, template_brainmask, template_images=template_images, **registration_options)
+
+    return run_subject_from_transforms(
+        image, brainmask, synthseg, wmh_seg, atlas, output_folder, transforms, cache, [registration_key],
+        native_spacing=native_spacing, lean_distances=lean_distances, crop_margin=registration_options.get('crop_margin'),
+        compression_level=compression_level, save_distance_maps=save_distance_maps, boundaries=boundaries, brain_volumes=brain_volumes,
+        lesion_statistics=lesion_statistics, label_maps=label_maps, atlas_image=atlas_image,
+    )
+
+@image_cache()
+def run_subject_from_transforms(image, brainmask, synthseg, wmh_seg, atlas, output_folder, transforms, cache, transforms_keys, native_spacing=True, lean_distances=False, crop_margin=None,
+                                compression_level=None, save_distance_maps=True, boundaries=RING_BOUNDARIES, brain_volumes=False,
+                                lesion_statistics=False, label_maps=None, atlas_image=None):
+    """
+    runs the stages of run_subject after registration: atlas_warp, distance_maps, normdist, layers, parcellation and stats.
+    transforms: list of transforms mapping the atlas to the subject image, in the order of application (see apply_ants_transforms)
+    cache: the StageCache of output_folder
+    transforms_keys: the stage keys the transforms were produced by
+    atlas_image: optional preloaded ANTsImage of the atlas, warped instead of reading the atlas file
+    """
+    if not label_maps:
+        registered_atlas_file, atlas_key = cache.run(
+            "atlas_warp",
+            lambda: warp_atlas(image, atlas_image if atlas_image is not None else atlas, transforms, output_folder, image_mask=brainmask, crop_margin=crop_margin, compression_level=compression_level),
+            input_files={'image': image, 'atlas': atlas, 'image_mask': brainmask},
+            params={'crop_margin': crop_margin, 'compression_level': compression_level},
+            upstream=transforms_keys,
+        )
+    else:
+        # the transforms are composed once, and the field reused for every label map and later runs with other label maps
+        _check_label_map_names(label_maps)
+        field, field_key = cached_composed_transform(cache, image, transforms, transforms_keys, output_folder, brainmask, crop_margin)
+        warped_files, atlas_key = cache.run(
+            "atlas_warp",
+            lambda: warp_label_maps(image, {'lobe_atlas': ants_to_sitk(atlas_image) if atlas_image is not None else atlas, **label_maps}, field, output_folder, compression_level=compression_level),
+            input_files={'image': image, 'atlas': atlas, **{'label_map_' + name: path for name, path in label_maps.items()}},
+            params={'compression_level': compression_level, 'composed': True},
+            upstream=[field_key],
+        )
+        registered_atlas_file = warped_files['lobe_atlas']
+
+    # normalised ventricle-cortex distance, which any layering is made from
+    if save_distance_maps:
+        print("computing ventricle and cortex distance transforms")
+        (ventmap_outimage, cortexmap_outimage), distance_key = cache.run(
+            "distance_maps",
+            lambda: postprocess_synthseg(image, synthseg, output_folder, native_spacing=native_spacing, lean=lean_distances, brainmask=brainmask, compression_level=compression_level),
+            input_files={'image': image, 'synthseg': synthseg, 'brainmask': brainmask if lean_distances else None},
+            params={'native_spacing': native_spacing, 'lean': lean_distances, 'compression_level': compression_level},
+        )
+        norm_dist_file, norm_dist_key = cache.run(
+            "normdist",
+            lambda: create_norm_dist_file(image, ventmap_outimage, cortexmap_outimage, brainmask, output_folder, compression_level=compression_level),
+            input_files={'image': image, 'brainmask': brainmask},
+            params={'compression_level': compression_level},
+            upstream=[distance_key],
+        )
+    else:
+        print("computing ventricle and cortex distance transforms")
+        norm_dist_file, norm_dist_key = cache.run(
+            "normdist",
+            lambda: create_norm_dist_file_from_synthseg(image, synthseg, brainmask, output_folder, native_spacing=native_spacing, lean=lean_distances, compression_level=compression_level),
+            input_files={'image': image, 'synthseg': synthseg, 'brainmask': brainmask},
+            params={'native_spacing': native_spacing, 'lean': lean_distances, 'compression_level': compression_level, 'save_distance_maps': False},
+        )
 
     # create concentric rings
-    pv_rings_file = compute_concentric_layers(args.image, args.synthseg, args.brainmask, args.output_folder)
+    print("creating concentric layers images")
+    pv_rings_file, layers_key = cache.run(
+        "layers",
+        lambda: create_pv_rings_from_norm_dist(norm_dist_file, boundaries, compression_level=compression_level),
+        params={'boundaries': list(boundaries), 'compression_level': compression_level},
+        upstream=[norm_dist_key],
+    )
 
     # create bullseye parcellation image
-    parc_file = save_brain_parcellation_image(registered_atlas_file, pv_rings_file)
+    n_layers = len(boundaries) + 1
+    parc_file, parc_key = cache.run(
+        "parcellation",
+        lambda: save_brain_parcellation_image(registered_atlas_file, pv_rings_file, compression_level=compression_level, n_layers=n_layers),
+        params={'compression_level': compression_level, 'n_layers': n_layers},
+        upstream=[atlas_key, layers_key],
+    )
 
     # calculate parcellation stats
-    df = calc_parc_stats(args.image, parc_file, args.wmh_seg)
+    stats_file, _ = cache.run(
+        "stats",
+        lambda: save_parc_stats(image, parc_file, wmh_seg, n_layers),
+        input_files={'image': image, 'wmh_seg': wmh_seg},
+        params={'n_layers': n_layers},
+        upstream=[parc_key],
+    )
+
+    if lesion_statistics:
+        cache.run(
+            "lesion_stats",
+            lambda: save_lesion_stats(image, parc_file, wmh_seg, n_layers),
+            input_files={'image': image, 'wmh_seg': wmh_seg},
+            params={'n_layers': n_layers},
+            upstream=[parc_key],
+        )
+
+    if brain_volumes:
+        stats_file, _ = cache.run(
+            "brain_volumes",
+            lambda: save_brain_volumes(image, parc_file, wmh_seg, registered_atlas_file, synthseg, brainmask, n_layers),
+            input_files={'image': image, 'wmh_seg': wmh_seg, 'synthseg': synthseg, 'brainmask': brainmask},
+            params={'n_layers': n_layers},
+            upstream=[parc_key, atlas_key],
+        )
+
+    return pd.read_csv(stats_file, index_col=0)
+
+# the preview registers with the fastest registration profile
+PREVIEW_PROFILE = 'fast'
+
+def preview_images(image, brainmask, synthseg, output_folder, spacing=2.5):
+    """
+    downsamples the subject image to the preview voxel spacing (after smoothing it to avoid aliasing), and takes the
+    brainmask and synthseg labels on its grid. the preview image and brainmask are saved to output_folder for registration.
+    returns (preview image path, preview brainmask path, image, brainmask, synthseg) with the last three as sitk images
+    """
+    imagename = image.split(os.path.sep)[-1].split(".nii")[0]
+
+    image_img = sitk.Cast(read_image(image), sitk.sitkFloat32)
+    sigmas = [max(spacing - s, 0) / 2 for s in image_img.GetSpacing()]
+    if any(sigmas):
+        image_img = sitk.SmoothingRecursiveGaussian(image_img, sigmas)
+    image_img = resample_to_spacing(image_img, (spacing, spacing, spacing))
+    brainmask_img = resample_to_reference(read_image(brainmask), image_img, use_nearest_neighbor=True)
+    synthseg_img = resample_to_reference(read_image(synthseg), image_img, use_nearest_neighbor=True)
+
+    preview_image = os.path.join(output_folder, imagename + "_preview.nii.gz")
+    preview_brainmask = os.path.join(output_folder, imagename + "_preview_brainmask.nii.gz")
+    write_image(image_img, preview_image)
+    write_image(brainmask_img, preview_brainmask, kind='label')
+    return preview_image, preview_brainmask, image_img, brainmask_img, synthseg_img
+
+def preview_parcellation(image_img, brainmask_img, synthseg_img, atlas_img, wmh_seg, boundaries=RING_BOUNDARIES):
+    """
+    distance maps and bullseye parcellation on the preview grid of image_img (the brainmask, synthseg and warped atlas
+    are sitk images on the same grid). the parcellation is mapped back (nearest neighbour) to the grid of the wmh
+    segmentation, and the WMH volumes calculated there.
+    returns (the parcellation on the wmh grid as a sitk image, the WMH bullseye volumes as a one row dataframe)
+    """
+    vent_dist_img, cortex_dist_img = distance_maps_in_image_space(image_img, synthseg_img, native_spacing=True, lean=True, mask_img=brainmask_img)
+    norm_dist = norm_dist_array(vent_dist_img, cortex_dist_img)
+    brain_rois = bullseye_labels(norm_dist, sitk.GetArrayFromImage(brainmask_img) == 1, sitk.GetArrayFromImage(atlas_img), boundaries)
+    del norm_dist
+
+    wmh_header = read_header(wmh_seg)
+    brain_rois_img = resample_to_reference(image_from_array(brain_rois, image_img), wmh_header, use_nearest_neighbor=True)
+    df = parc_stats(sitk.GetArrayViewFromImage(brain_rois_img), load_image(wmh_seg), np.prod(wmh_header.GetSpacing()), len(boundaries) + 1)
+    return brain_rois_img, df
+
+def run_subject_preview(image, brainmask, synthseg, wmh_seg, template, atlas, output_folder, template_brainmask=None, spacing=2.5, use_cache=True,
+                        threads=None, random_seed=None, boundaries=RING_BOUNDARIES, brain_volumes=False, lesion_statistics=False, compression_level=None, report=None):
+    """
+    approximate parcellation for quick triage: the subject images are downsampled to spacing (mm), the template is
+    registered to them with the PREVIEW_PROFILE and the distance maps and parcellation are computed on that grid.
+    the parcellation is mapped back to the grid of the wmh segmentation for the stats. the outputs are saved to
+    <output_folder>/preview, and the (cached) registration is reused by later previews of the subject.
+    returns the WMH bullseye volumes as a one row dataframe, see preview_deviation to compare them to a full run.
+    brain_volumes: also calculate the lobe, ICV and SynthSeg volumes on the wmh grid (with the preview atlas mapped back
+    to it), saved as *_brain_vols.csv and returned instead of only the WMH volumes
+    lesion_statistics: also calculate the lesion level statistics within the preview parcellation (see lesion_stats)
+    the stages are recorded in the report with a preview_ prefix, so they can share a report with a full run.
+    """
+    preview_folder = os.path.join(output_folder, "preview")
+    os.makedirs(preview_folder, exist_ok=True)
+    imagename = image.split(os.path.sep)[-1].split(".nii")[0]
 
+    with measure(report, "preview_images"):
+        preview_image, preview_brainmask, image_img, brainmask_img, synthseg_img = preview_images(image, brainmask, synthseg, preview_folder, spacing)
+
+    cache = StageCache(preview_folder, enabled=use_cache, report=report, report_prefix="preview_")
+    transforms, _ = cached_registration(cache, preview_image, template, preview_folder, preview_brainmask, template_brainmask, profile=PREVIEW_PROFILE, threads=threads, random_seed=random_seed)
+
+    print("applying ants transform")
+    with measure(report, "preview_atlas_warp"):
+        atlas_img = ants_to_sitk(apply_ants_transforms(preview_image, atlas, None, list(transforms), is_label=True, write=False), image_img)
+
+    print("computing the preview parcellation")
+    with measure(report, "preview_parcellation"):
+        brain_rois_img, df = preview_parcellation(image_img, brainmask_img, synthseg_img, atlas_img, wmh_seg, boundaries)
+
+    parc_file = os.path.join(preview_folder, imagename + "_preview_bullseye_parc" + layering_suffix(boundaries) + output_ending(compression_level))
+    write_image(brain_rois_img, parc_file, kind='label', compression_level=compression_level)
     df.to_csv(parc_file.split(".nii")[0] + "_wmh_vols.csv")
+    print("saved preview bullseye parcellation image to: ", parc_file)
+
+    n_layers = len(boundaries) + 1
+    if lesion_statistics:
+        with measure(report, "preview_lesion_stats"):
+            # the parcellation is on the wmh grid, so the wmh segmentation gives the voxel size
+            save_lesion_stats(wmh_seg, parc_file, wmh_seg, n_layers)
+
+    if brain_volumes:
+        with measure(report, "preview_brain_volumes"):
+            wmh_header = read_header(wmh_seg)
+            def on_wmh_grid(label_img):
+                if not same_grid(label_img, wmh_header):
+                    label_img = resample_to_reference(label_img, wmh_header, use_nearest_neighbor=True)
+                # a copy, as a view does not keep the (resampled) image alive
+                return sitk.GetArrayFromImage(label_img)
+            volumes = get_all_brain_volumes({
+                'brainroi': sitk.GetArrayViewFromImage(brain_rois_img),
+                'wmh': load_image(wmh_seg),
+                'atlas': on_wmh_grid(atlas_img),
+                'synthseg': on_wmh_grid(read_image(synthseg)),
+                'brainmask': on_wmh_grid(read_image(brainmask)),
+                'voxel_size': np.prod(wmh_header.GetSpacing()),
+            }, n_layers)
+            df = pd.DataFrame({key: [value] for key, value in volumes.items()})
+            df.to_csv(parc_file.split(".nii")[0] + "_brain_vols.csv")
+    return df
+
+def preview_deviation(preview_df, full_df):
+    """
+    deviation of preview WMH volumes from those of a full run (one row dataframes), per region and in total.
+    returns a dataframe with the columns region, full, preview, difference and relative_difference (nan where the full volume is 0)
+    """
+    columns = [column for column in full_df.columns if column.startswith("wmh_") and column in preview_df.columns and column != "wmh_total"]
+    full = full_df.iloc[0][columns].to_numpy(dtype=np.float64)
+    preview = preview_df.iloc[0][columns].to_numpy(dtype=np.float64)
+    deviation = pd.DataFrame({
+        'region': [column[len("wmh_"):] for column in columns] + ['total'],
+        'full': np.r_[full, full.sum()],
+        'preview': np.r_[preview, preview.sum()],
+    })
+    deviation['difference'] = deviation['preview'] - deviation['full']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation['relative_difference'] = np.where(deviation['full'] > 0, deviation['difference'] / deviation['full'], np.nan)
+    return deviation
+
+def subject_report(image, output_folder, profile_stages=False):
+    """creates a RunReport for a subject, named after its image, optionally profiling each stage"""
+    profiler = cprofile_hook(os.path.join(output_folder, "profiles")) if profile_stages else None
+    return RunReport(image.split(os.path.sep)[-1].split(".nii")[0], profiler=profiler, image=image, **image_info(image))
+
+def run_preview(args, options, report=None):
+    """
+    runs the preview of a subject from the command line arguments and reports its deviation from a full run:
+    the full pipeline is also run with --preview_validate, otherwise a full run already in the output folder is used.
+    returns the preview WMH volumes.
+    """
+    if options['label_maps']:
+        raise ValueError("--label_maps is not supported with --preview, the preview only warps the lobe atlas")
+    imagename = args.image.split(os.path.sep)[-1].split(".nii")[0]
+    df = run_subject_preview(
+        args.image, args.brainmask, args.synthseg, args.wmh_seg, args.template, args.atlas, args.output_folder,
+        template_brainmask=args.template_brainmask, spacing=args.preview_spacing, use_cache=options['use_cache'], threads=args.threads,
+        random_seed=args.random_seed, boundaries=options['boundaries'], brain_volumes=options['brain_volumes'],
+        lesion_statistics=options['lesion_statistics'], compression_level=options['compression_level'], report=report,
+    )
+
+    full_stats_file = os.path.join(args.output_folder, imagename + "_bullseye_parc" + layering_suffix(options['boundaries']) + "_wmh_vols.csv")
+    if args.preview_validate:
+        run = run_subject_in_memory if args.in_memory else run_subject
+        run(args.image, args.brainmask, args.synthseg, args.wmh_seg, args.template, args.atlas, args.output_folder, report=report, **options)
+    if not os.path.exists(full_stats_file):
+        print("no full run in the output folder to compare the preview to (run with --preview_validate to run one)")
+        return df
+
+    deviation = preview_deviation(df, pd.read_csv(full_stats_file, index_col=0))
+    deviation_file = os.path.join(args.output_folder, "preview", imagename + "_preview_deviation.csv")
+    deviation.to_csv(deviation_file, index=False)
+    regions, total = deviation.iloc[:-1], deviation.iloc[-1]
+    print(f"preview total WMH {total['preview']:.1f} mm^3 vs {total['full']:.1f} mm^3 in the full run ({100 * total['relative_difference']:+.1f}%)")
+    print(f"per region: mean absolute difference {regions['difference'].abs().mean():.1f} mm^3, largest {regions['difference'].abs().max():.1f} mm^3")
+    print("saved the deviation from the full run to: ", deviation_file)
+    return df
+
+def main(args):
+    options = dict(
+        template_brainmask=args.template_brainmask,
+        use_cache=not args.no_cache,
+        native_spacing=not args.resample_1mm_distances,
+        lean_distances=args.lean_distances,
+        profile=args.registration_profile,
+        threads=args.threads,
+        random_seed=args.random_seed,
+        crop_margin=args.crop_margin,
+        compression_level=args.compression_level,
+        save_distance_maps=not args.no_distance_maps,
+        boundaries=resolve_boundaries(args.layers, args.layer_boundaries),
+        brain_volumes=args.brain_volumes or args.store is not None,
+        lesion_statistics=args.lesion_stats,
+        label_maps=parse_label_maps(args.label_maps),
+    )
+    report = subject_report(args.image, args.output_folder, args.profile_stages) if args.report else None
+    try:
+        if args.preview:
+            df = run_preview(args, options, report)
+        elif args.in_memory:
+            df = run_subject_in_memory(args.image, args.brainmask, args.synthseg, args.wmh_seg, args.template, args.atlas, args.output_folder, save_intermediates=args.save_intermediates, report=report, **options)
+        else:
+            df = run_subject(args.image, args.brainmask, args.synthseg, args.wmh_seg, args.template, args.atlas, args.output_folder, report=report, **options)
+        if args.store is not None:
+            run_name = args.run_name + "_preview" if args.preview else args.run_name
+            store = ResultsStore(args.store)
+            store.upsert(df, args.image.split(os.path.sep)[-1].split(".nii")[0], run_name)
+            store.compact_if_needed()
+    finally:
+        if report is not None:
+            os.makedirs(args.output_folder, exist_ok=True)
+            report.write(os.path.join(args.output_folder, report.subject + "_run_report.json"))
 
 if __name__ == '__main__':
     parser = construct_parser()
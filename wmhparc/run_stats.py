@@ -0,0 +1,27 @@
+"""
+Calculate the bullseye WMH volumes of several WMH segmentations, or of probabilistic WMH maps at several thresholds,
+from an existing bullseye parcellation image.
+"""
+import argparse
+from wmhparc.parcellate_image import calc_parc_stats_multi, N_LAYERS
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--image', required=True, type=str, help="path to the anatomical subject image the parcellation was computed for (used for the voxel size)")
+    parser.add_argument('-p', '--parc', required=True, type=str, help="path to the bullseye_parc image of the subject")
+    parser.add_argument('-w', '--wmh_segs', required=True, nargs='+', type=str, help="paths to one or more WMH segmentation or probability map files")
+    parser.add_argument('--thresholds', default=None, nargs='+', type=float, help="binarise each WMH map at each of these thresholds (voxels >= threshold)")
+    parser.add_argument('--layers', default=N_LAYERS, type=int, help=f"number of concentric layers the parcellation was made with (default: {N_LAYERS})")
+    parser.add_argument('-o', '--output', required=True, type=str, help="path of the output csv, with one row per WMH map and threshold")
+
+    return parser
+
+def main(args):
+    df = calc_parc_stats_multi(args.image, args.parc, args.wmh_segs, thresholds=args.thresholds, n_layers=args.layers)
+    df.to_csv(args.output, index=False)
+    print("saved WMH volumes to: ", args.output)
+
+if __name__ == '__main__':
+    parser = construct_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,110 @@
+"""
+Content hashed cache for the pipeline stages.
+
+Each stage is keyed by a hash of the contents of its input files, its parameters and the keys of the
+stages it depends on, which include the contents of the files those stages wrote (so a stage rerun with
+a different result, e.g an unseeded registration, also reruns the stages downstream of it). The key and the outputs of each stage are recorded in a json file in the output
+folder, and a stage whose key is unchanged and whose outputs still exist is skipped.
+"""
+import os
+import json
+import hashlib
+from wmhparc.instrumentation import measure
+
+CACHE_FILENAME = ".wmhparc_stages.json"
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """sha256 of the contents of a file"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _output_paths(outputs):
+    if isinstance(outputs, str):
+        return [outputs]
+    if isinstance(outputs, (list, tuple)):
+        return [path for output in outputs for path in _output_paths(output)]
+    if isinstance(outputs, dict):
+        return [path for output in outputs.values() for path in _output_paths(output)]
+    return []
+
+class StageCache:
+    """
+    output_folder: folder where the stage record is stored (the subject output folder).
+    enabled: if False every stage is run, but the record is still updated so later runs can reuse the results.
+    report: optional RunReport, the stages that are run (or skipped) are recorded in it.
+    report_prefix: prefix of the stage names in the report, e.g to tell apart the stages of two pipelines in one report
+    """
+    def __init__(self, output_folder, enabled=True, report=None, report_prefix=""):
+        self.path = os.path.join(output_folder, CACHE_FILENAME)
+        self.enabled = enabled
+        self.report = report
+        self.report_prefix = report_prefix
+        self.record = {"stages": {}, "files": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.record = json.load(f)
+            except (OSError, ValueError):
+                print(f"could not read stage cache {self.path}, all stages will be rerun")
+
+    def _file_digest(self, filepath):
+        # digests are reused while the file size and modification time are unchanged
+        stat = os.stat(filepath)
+        filepath = os.path.abspath(filepath)
+        cached = self.record["files"].get(filepath)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        digest = file_digest(filepath)
+        self.record["files"][filepath] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def key(self, stage, input_files=None, params=None, upstream=()):
+        """
+        stage: name of the stage
+        input_files: dict of name -> filepath (or None for optional inputs not given)
+        params: json serialisable dict of the stage parameters
+        upstream: keys of the stages this stage depends on
+        """
+        input_files = input_files or {}
+        description = {
+            "stage": stage,
+            "inputs": {name: (self._file_digest(path) if path is not None else None) for name, path in sorted(input_files.items())},
+            "params": params or {},
+            "upstream": list(upstream),
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def run(self, stage, fn, input_files=None, params=None, upstream=()):
+        """
+        runs fn() unless a previous run of the stage had the same key and its outputs still exist.
+        fn must return the output filepath(s) of the stage (a path, or a list/tuple/dict of paths).
+        returns (outputs, key), where key also covers the contents of the outputs, to pass as upstream to later stages
+        """
+        key = self.key(stage, input_files, params, upstream)
+        previous = self.record["stages"].get(stage)
+        if self.enabled and previous is not None and previous["key"] == key and all(os.path.exists(path) for path in _output_paths(previous["outputs"])):
+            print(f"skipping stage {stage}, inputs unchanged")
+            if self.report is not None:
+                self.report.skipped(self.report_prefix + stage, reason="cached")
+            return previous["outputs"], self._outputs_key(key, previous["outputs"])
+
+        with measure(self.report, self.report_prefix + stage):
+            outputs = fn()
+        outputs_key = self._outputs_key(key, outputs)
+        self.record["stages"][stage] = {"key": key, "outputs": outputs}
+        self.save()
+        return outputs, outputs_key
+
+    def _outputs_key(self, key, outputs):
+        """the stage key combined with the digests of the files the stage wrote"""
+        digests = [self._file_digest(path) if os.path.isfile(path) else None for path in _output_paths(outputs)]
+        return hashlib.sha256(json.dumps([key, digests]).encode()).hexdigest()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.record, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -1,38 +1,218 @@
 import SimpleITK as sitk
+import numpy as np
 import os
-import subprocess
+import sys
+import gzip
+import shutil
+from contextlib import contextmanager
+
+# on disk pixel type of the distance maps, label images use the smallest of uint8 / int16 / int32 that holds their labels
+DISTANCE_PIXEL_TYPE = sitk.sitkFloat32
+
+# numpy dtypes of the nifti datatype codes
+NIFTI_DTYPES = {
+    2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+    256: np.int8, 512: np.uint16, 768: np.uint32, 1024: np.int64, 1280: np.uint64,
+}
+
+# decoded sitk images by (path, modification time, size), while an image_cache block is active
+_image_cache = None
+
+@contextmanager
+def image_cache():
+    """
+    within the block each image file is only decoded once: read_image and load_image reuse the decoded image
+    while the file is unchanged. nested blocks share the outermost cache, which is dropped when it exits.
+    """
+    global _image_cache
+    outermost = _image_cache is None
+    if outermost:
+        _image_cache = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            _image_cache = None
+
+def read_header(filepath):
+    """
+    reads the header of an image without loading its voxels.
+    returns a sitk.ImageFileReader, which has GetSize, GetSpacing, GetOrigin, GetDirection and GetMetaData
+    like a sitk image, so can be used in its place for metadata checks (e.g same_grid, resample_to_reference).
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(filepath))
+    reader.ReadImageInformation()
+    return reader
+
+def read_image(filepath):
+    """sitk.ReadImage, decoding the file only once within an image_cache block"""
+    if _image_cache is None:
+        return sitk.ReadImage(filepath)
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    if key not in _image_cache:
+        _image_cache[key] = sitk.ReadImage(filepath)
+    # copy on write, so the cached image is not changed by the caller
+    return sitk.Image(_image_cache[key])
+
+def nifti_memmap(filepath, header=None):
+    """
+    read only memory map of the voxels of an uncompressed .nii file, as an array indexed (z, y, x).
+    returns None if the voxels can't be mapped as they are (scaled, non native byte order, vector or 4D images).
+    """
+    header = header if header is not None else read_header(filepath)
+    keys = ('datatype', 'vox_offset', 'scl_slope', 'scl_inter', 'dim[0]')
+    if not all(header.HasMetaDataKey(key) for key in keys):
+        return None
+    dtype = NIFTI_DTYPES.get(int(header.GetMetaData('datatype')))
+    slope, intercept = float(header.GetMetaData('scl_slope')), float(header.GetMetaData('scl_inter'))
+    if dtype is None or header.GetNumberOfComponents() != 1 or int(header.GetMetaData('dim[0]')) != 3 or slope not in (0, 1) or intercept != 0:
+        return None
+
+    # the header size (348 for nifti-1, 540 for nifti-2) is stored first, in the byte order of the file
+    with open(filepath, "rb") as f:
+        if int.from_bytes(f.read(4), sys.byteorder) not in (348, 540):
+            return None
+    offset = int(float(header.GetMetaData('vox_offset')))
+    shape = tuple(header.GetSize()[::-1])
+    if os.path.getsize(filepath) < offset + np.prod(shape) * np.dtype(dtype).itemsize:
+        return None
+    return np.asarray(np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=shape))
 
 def load_image(filepath):
-    return sitk.GetArrayFromImage(sitk.ReadImage(filepath))
+    """
+    voxel array of an image, indexed (z, y, x).
+    uncompressed .nii files are memory mapped read only, other files are decoded (once, within an image_cache block).
+    """
+    if str(filepath).endswith(".nii"):
+        array = nifti_memmap(filepath)
+        if array is not None:
+            return array
+    return sitk.GetArrayFromImage(read_image(filepath))
 
-def save_manipulated_sitk_image_array(source_image, target_array, filepath):
-    """Saves a manipulated nifti image array using the meta data information from a source image"""
+def image_from_array(target_array, source_image):
+    """Creates a sitk image from an array using the meta data information from a source image (or header, see read_header)"""
     target_image = sitk.GetImageFromArray(target_array)
     target_image.SetSpacing(source_image.GetSpacing())
     target_image.SetOrigin(source_image.GetOrigin())
     target_image.SetDirection(source_image.GetDirection())
-    target_image.CopyInformation(source_image)
-    sitk.WriteImage(target_image, filepath)
+    return target_image
+
+def label_pixel_type(image):
+    """smallest integer sitk pixel type (uint8, int16 or int32) that holds the labels of a sitk image"""
+    stats = sitk.MinimumMaximumImageFilter()
+    stats.Execute(image)
+    if stats.GetMinimum() >= 0 and stats.GetMaximum() <= np.iinfo(np.uint8).max:
+        return sitk.sitkUInt8
+    if stats.GetMinimum() >= np.iinfo(np.int16).min and stats.GetMaximum() <= np.iinfo(np.int16).max:
+        return sitk.sitkInt16
+    return sitk.sitkInt32
 
-def resample_match_if_necessary(fixed, moving, use_nearest_neighbor=False):
+def output_ending(compression_level=None, default=".nii.gz"):
+    """file ending of an output image: default if no compression level is given, .nii for level 0 and .nii.gz otherwise"""
+    if compression_level is None:
+        return default
+    return ".nii" if compression_level == 0 else ".nii.gz"
+
+def write_image(image, filepath, kind=None, compression_level=None):
     """
-    resample moving to fixed if moving and fixed are not in the same space.
+    writes a sitk image, cast to the on disk pixel type of its kind:
+    'label' for label images (see label_pixel_type), 'distance' for distance maps (DISTANCE_PIXEL_TYPE)
+    or None to keep its pixel type.
+    compression_level: gzip level 1-9 for .nii.gz files (default: the ITK default level)
     """
-    fixed_spacing = sitk.ReadImage(fixed).GetSpacing()
-    moving_spacing = sitk.ReadImage(moving).GetSpacing()
+    if kind == 'label':
+        pixel_type = label_pixel_type(image)
+    elif kind == 'distance':
+        pixel_type = DISTANCE_PIXEL_TYPE
+    elif kind is None:
+        pixel_type = image.GetPixelID()
+    else:
+        raise ValueError(f"unknown image kind {kind}")
+    if pixel_type != image.GetPixelID():
+        image = sitk.Cast(image, pixel_type)
 
-    if (abs(fixed_spacing[0] - moving_spacing[0]) <= 0.05) and (abs(fixed_spacing[1] - moving_spacing[1]) <= 0.05) and (abs(fixed_spacing[2] - moving_spacing[2]) <= 0.05):
+    if compression_level is None or not filepath.endswith(".nii.gz"):
+        sitk.WriteImage(image, filepath)
         return
-    
-    interp = "trilinear"
-    if use_nearest_neighbor:
-        interp = "nearest"
-
-    command = [
-        "mri_vol2vol", "--mov", moving, "--targ", fixed, "--o", moving, "--regheader", "--interp", interp
-    ]
-    
-    _ = subprocess.call(command, stdout=subprocess.DEVNULL)
+
+    # the ITK nifti writer ignores the compression level, so the image is written uncompressed and gzipped here
+    tmp_path = filepath[:-len(".gz")] + ".tmp.nii"
+    try:
+        sitk.WriteImage(image, tmp_path)
+        with open(tmp_path, "rb") as src, gzip.open(filepath, "wb", compresslevel=compression_level) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def save_manipulated_sitk_image_array(source_image, target_array, filepath, kind=None, compression_level=None):
+    """Saves a manipulated nifti image array using the meta data information from a source image (see write_image for kind and compression_level)"""
+    write_image(image_from_array(target_array, source_image), filepath, kind=kind, compression_level=compression_level)
+
+def spacings_match(spacing_a, spacing_b, tolerance=0.05):
+    return all(abs(a - b) <= tolerance for a, b in zip(spacing_a, spacing_b))
+
+def same_grid(image_a, image_b, tolerance=1e-4):
+    """whether two sitk images share the same voxel grid (size, spacing, origin and direction)"""
+    return (
+        image_a.GetSize() == image_b.GetSize()
+        and np.allclose(image_a.GetSpacing(), image_b.GetSpacing(), rtol=0, atol=tolerance)
+        and np.allclose(image_a.GetOrigin(), image_b.GetOrigin(), rtol=0, atol=tolerance)
+        and np.allclose(image_a.GetDirection(), image_b.GetDirection(), rtol=0, atol=tolerance)
+    )
+
+def resample_to_reference(image, reference, use_nearest_neighbor=False):
+    """
+    resamples a sitk image into the voxel grid of a reference sitk image (or header, see read_header), using the
+    scanner coordinates of both images (the in memory equivalent of mri_vol2vol --regheader).
+    """
+    interpolator = sitk.sitkNearestNeighbor if use_nearest_neighbor else sitk.sitkLinear
+    return sitk.Resample(
+        image, reference.GetSize(), sitk.Transform(), interpolator,
+        reference.GetOrigin(), reference.GetSpacing(), reference.GetDirection(), 0.0, image.GetPixelID(),
+    )
+
+def resample_to_spacing(image, spacing=(1, 1, 1), use_nearest_neighbor=False):
+    """
+    resamples a sitk image to the given voxel spacing, keeping the field of view centred
+    (the in memory equivalent of mri_convert -vs).
+    """
+    old_size = np.array(image.GetSize())
+    old_spacing = np.array(image.GetSpacing())
+    spacing = np.array(spacing, dtype=np.float64)
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+
+    size = np.maximum(np.round(old_size * old_spacing / spacing), 1).astype(int)
+    # the centre of the field of view (voxel size / 2, as in freesurfer) is kept fixed
+    centre = np.array(image.GetOrigin()) + direction @ (old_spacing * old_size / 2)
+    origin = centre - direction @ (spacing * size / 2)
+
+    interpolator = sitk.sitkNearestNeighbor if use_nearest_neighbor else sitk.sitkLinear
+    return sitk.Resample(
+        image, [int(s) for s in size], sitk.Transform(), interpolator,
+        [float(o) for o in origin], [float(s) for s in spacing], image.GetDirection(), 0.0, image.GetPixelID(),
+    )
+
+def parse_label_maps(items):
+    """
+    parses name=path command line arguments into a dict of name -> path (None if no items are given).
+    names are used in the output filenames, so may only contain letters, digits, - and _
+    """
+    if not items:
+        return None
+    label_maps = {}
+    for item in items:
+        name, sep, path = item.partition("=")
+        if not sep or not name or not path:
+            raise ValueError(f"label maps must be given as name=path, not {item}")
+        if not all(c.isalnum() or c in "-_" for c in name):
+            raise ValueError(f"label map names may only contain letters, digits, - and _, not {name}")
+        if name in label_maps:
+            raise ValueError(f"the label map name {name} is given more than once")
+        label_maps[name] = path
+    return label_maps
 
 def fileending(filepath):
     ending = ".nii" if filepath.endswith(".nii") else ".nii.gz" if filepath.endswith(".nii.gz") else None